@@ -0,0 +1,226 @@
+import logging
+import os
+import sys
+import time
+from pymongo import MongoClient, UpdateOne
+from mongo_utils import (
+    get_watermark,
+    object_id_partitions,
+    retry_on_duplicate_key,
+    run_partitioned,
+    set_watermark,
+)
+
+# Logger
+os.makedirs("logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.FileHandler("logs/extract_ips_and_products.log"),
+        logging.StreamHandler(sys.stdout),
+    ],
+)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+
+# Watermarks shared with 1.extract_distinct_ips.py and 3.product-name-collection-init.py
+IP_WATERMARK_KEY = "distinct_ips.summary_id"
+PRODUCT_WATERMARK_KEY = "product_names.summary_id"
+INCREMENTAL = True
+
+# Partitioned scan, same meaning as in steps 1 and 3
+PARTITIONS = 1
+CONCURRENCY = 4
+
+PRODUCT_COLLECTIONS = [
+    "view_product_detail",
+    "select_product_option",
+    "select_product_option_quality",
+]
+
+# Per-event expressions deciding which outputs an event feeds
+HAS_IP = {"$ne": [{"$ifNull": ["$ip", ""]}, ""]}
+HAS_PRODUCT = {
+    "$and": [
+        {"$in": ["$collection", PRODUCT_COLLECTIONS]},
+        {"$ne": [{"$ifNull": ["$product_id", ""]}, ""]},
+    ]
+}
+
+
+def build_pipeline(id_range):
+    """One scan of summary that groups IPs and products side by side.
+
+    Each event is expanded into at most two tagged keys ("ip" / "product") and a
+    single $group dedups both kinds, so the caller can fan rows out by tag.
+    $facet is avoided on purpose: its single output document is capped at 16 MB,
+    far below the 3.2M distinct IPs.
+    """
+    return [
+        {
+            "$match": {
+                "_id": id_range,
+                "$or": [
+                    {"ip": {"$exists": True, "$nin": [None, ""]}},
+                    {
+                        "collection": {"$in": PRODUCT_COLLECTIONS},
+                        "product_id": {"$exists": True, "$nin": [None, ""]},
+                    },
+                ],
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "keys": {
+                    "$concatArrays": [
+                        {"$cond": [HAS_IP, [{"t": "ip", "v": "$ip"}], []]},
+                        {
+                            "$cond": [
+                                HAS_PRODUCT,
+                                [
+                                    {
+                                        "t": "product",
+                                        "v": "$product_id",
+                                        "url": "$current_url",
+                                    }
+                                ],
+                                [],
+                            ]
+                        },
+                    ]
+                },
+            }
+        },
+        {"$unwind": "$keys"},
+        {
+            "$group": {
+                "_id": {"t": "$keys.t", "v": "$keys.v"},
+                "current_url": {"$first": "$keys.url"},
+            }
+        },
+    ]
+
+
+def ip_upsert(ip):
+    return UpdateOne(
+        {"ip": ip},
+        {"$setOnInsert": {"ip": ip, "location": None, "status": "pending"}},
+        upsert=True,
+    )
+
+
+def product_upsert(product_id, current_url):
+    return UpdateOne(
+        {"product_id": product_id},
+        {
+            "$setOnInsert": {
+                "product_id": product_id,
+                "current_url": current_url or "",
+                "product_name": None,
+                "status": "pending",
+            }
+        },
+        upsert=True,
+    )
+
+
+def extract_id_range(db, id_range):
+    """Stream one partition of the single-pass pipeline into both target collections"""
+    ip_col = db["distinct_ips"]
+    product_col = db["product_names"]
+    outputs = {"ip": [ip_col, [], 0], "product": [product_col, [], 0]}
+
+    def flush(kind):
+        collection, operations, _ = outputs[kind]
+        result = retry_on_duplicate_key(
+            lambda: collection.bulk_write(operations, ordered=False)
+        )
+        outputs[kind][2] += result.upserted_count
+        outputs[kind][1] = []
+
+    logger.info(f"Scanning summary _id {id_range}...")
+    cursor = db["summary"].aggregate(
+        build_pipeline(id_range), allowDiskUse=True, batchSize=BATCH_SIZE
+    )
+    for doc in cursor:
+        kind = doc["_id"]["t"]
+        value = doc["_id"]["v"]
+        if kind == "ip":
+            outputs[kind][1].append(ip_upsert(value))
+        else:
+            outputs[kind][1].append(product_upsert(value, doc.get("current_url")))
+        if len(outputs[kind][1]) >= BATCH_SIZE:
+            flush(kind)
+
+    for kind in outputs:
+        if outputs[kind][1]:
+            flush(kind)
+
+    logger.info(
+        f"Partition {id_range}: {outputs['ip'][2]} new IPs, {outputs['product'][2]} new products"
+    )
+    return outputs["ip"][2], outputs["product"][2]
+
+
+def extract_ips_and_products(
+    incremental=INCREMENTAL, partitions=PARTITIONS, concurrency=CONCURRENCY
+):
+    client = None
+    try:
+        client = MongoClient("mongodb://localhost:27017/")
+        db = client["countly"]
+        summary_col = db["summary"]
+        start_time = time.time()
+
+        newest = summary_col.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        if newest is None:
+            logger.info("No summary events found.")
+            return
+        high_watermark = newest["_id"]
+
+        # Resume from the older of the two watermarks so neither output misses events
+        lower = None
+        if incremental:
+            watermarks = [
+                get_watermark(db, IP_WATERMARK_KEY),
+                get_watermark(db, PRODUCT_WATERMARK_KEY),
+            ]
+            if None not in watermarks:
+                lower = min(watermarks)
+
+        db["distinct_ips"].create_index("ip", unique=True)
+        db["product_names"].create_index("product_id", unique=True)
+
+        id_ranges = object_id_partitions(summary_col, partitions, lower, high_watermark)
+        results = run_partitioned(
+            lambda id_range: extract_id_range(db, id_range), id_ranges, concurrency
+        )
+        new_ips = sum(ips for ips, _ in results)
+        new_products = sum(products for _, products in results)
+
+        set_watermark(db, IP_WATERMARK_KEY, high_watermark)
+        set_watermark(db, PRODUCT_WATERMARK_KEY, high_watermark)
+        logger.info(
+            f"Single pass done in {time.time() - start_time:.2f}s: "
+            f"{new_ips} new IPs, {new_products} new products, watermark {high_watermark}"
+        )
+        logger.info(
+            f"distinct_ips: {db['distinct_ips'].estimated_document_count()} documents, "
+            f"product_names: {db['product_names'].estimated_document_count()} documents"
+        )
+
+    except Exception as e:
+        logger.critical(f"Script failed: {str(e)}", exc_info=True)
+        raise
+    finally:
+        if client is not None:
+            client.close()
+            logger.info("MongoDB connection closed")
+
+
+if __name__ == "__main__":
+    extract_ips_and_products()
@@ -1,6 +1,17 @@
 import logging
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, errors
+from ip2loc_index import IP2LocationIndex
+from mongo_utils import (
+    get_watermark,
+    merge_stage,
+    object_id_partitions,
+    retry_on_duplicate_key,
+    run_merge_pipeline,
+    run_partitioned,
+    run_partitioned_merges,
+    set_watermark,
+)
 
 # Logger
 os.makedirs("logs", exist_ok=True)
@@ -18,43 +29,252 @@ db = client["countly"]
 summary_col = db["summary"]
 ip_col = db["distinct_ips"]
 
-# Clear old data
-ip_col.drop()
-logger.info("Dropped old 'distinct_ips' collection if it existed.")
-
-# Aggregation Pipeline
-pipeline = [
-    {"$match": {"ip": {"$exists": True, "$ne": None, "$ne": ""}}},
-    {"$group": {"_id": "$ip"}},
-    {
-        "$project": {
-            "_id": 0,
-            "ip": "$_id",
-            "location": None,  # Use later on step 2
-            "status": "pending",  # get location from IP State
-        }
-    },
-]
-
-logger.info("Starting aggregation to extract distinct IPs...")
-cursor = summary_col.aggregate(pipeline, allowDiskUse=True)
-
-batch = []
-batch_size = 1000
-count = 0
-
-for doc in cursor:
-    batch.append(doc)
-    if len(batch) == batch_size:
+# Incremental mode keeps distinct_ips (and its enrichment) and only aggregates
+# summary events with _id above the stored watermark
+INCREMENTAL = True
+WATERMARK_KEY = "distinct_ips.summary_id"
+BATCH_SIZE = 1000
+
+# Server-side mode: end the pipeline with $merge so MongoDB writes distinct_ips
+# itself instead of streaming every group through this process
+SERVER_MERGE = False
+
+# Partitioned scan: split summary into PARTITIONS ObjectId time ranges and run the
+# group pipeline on up to CONCURRENCY of them at once (1 = single aggregation)
+PARTITIONS = 1
+CONCURRENCY = 4
+
+# Fused mode: resolve locations straight off the aggregation cursor and insert
+# finished ("done") documents, so step 2 has nothing left to update
+FUSED_ENRICH = False
+IP2LOC_DB_PATH = "ip2loc/IP2LOCATION-LITE-DB1.BIN"
+
+IP_MATCH = {"ip": {"$exists": True, "$nin": [None, ""]}}
+
+
+def summary_high_watermark():
+    """Newest summary _id, captured before aggregating so later events wait for the next run"""
+    newest = summary_col.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return newest["_id"] if newest else None
+
+
+def merge_distinct_ips(match):
+    """Group and $merge new IPs into distinct_ips without leaving the server"""
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$ip"}},
+        {
+            "$project": {
+                "_id": 0,
+                "ip": "$_id",
+                "location": {"$literal": None},
+                "status": {"$literal": "pending"},
+            }
+        },
+        merge_stage(ip_col, "ip"),
+    ]
+    logger.info(f"Starting server-side $merge for summary _id {match['_id']}...")
+    return retry_on_duplicate_key(
+        lambda: run_merge_pipeline(summary_col, pipeline, ip_col)
+    )
+
+
+def insert_distinct_ips(match):
+    """Stream groups to the client and insert them, only safe into an empty collection"""
+    # Aggregation Pipeline
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$ip"}},
+        {
+            "$project": {
+                "_id": 0,
+                "ip": "$_id",
+                "location": None,  # Use later on step 2
+                "status": "pending",  # get location from IP State
+            }
+        },
+    ]
+
+    logger.info("Starting aggregation to extract distinct IPs...")
+    cursor = summary_col.aggregate(pipeline, allowDiskUse=True)
+
+    batch = []
+    count = 0
+
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == BATCH_SIZE:
+            ip_col.insert_many(batch)
+            count += len(batch)
+            logger.info(f"Inserted {count} IPs so far...")
+            batch.clear()
+
+    # Insert remaining
+    if batch:
         ip_col.insert_many(batch)
         count += len(batch)
-        logger.info(f"Inserted {count} IPs so far...")
+        logger.info(f"Inserted final batch. Total inserted: {count}")
+
+    return count
+
+
+def upsert_distinct_ips(match):
+    """Stream groups to the client and upsert them, idempotent across runs and partitions"""
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$ip"}},
+    ]
+
+    logger.info(f"Starting aggregation for summary _id {match['_id']}...")
+    cursor = summary_col.aggregate(pipeline, allowDiskUse=True)
+
+    operations = []
+    seen = 0
+    inserted = 0
+
+    def flush():
+        nonlocal inserted
+        result = retry_on_duplicate_key(
+            lambda: ip_col.bulk_write(operations, ordered=False)
+        )
+        inserted += result.upserted_count
+        logger.info(f"Upserted {seen} IPs so far, {inserted} new...")
+        operations.clear()
+
+    for doc in cursor:
+        ip = doc["_id"]
+        # Existing IPs keep their location and status, only unseen ones become pending
+        operations.append(
+            UpdateOne(
+                {"ip": ip},
+                {"$setOnInsert": {"ip": ip, "location": None, "status": "pending"}},
+                upsert=True,
+            )
+        )
+        seen += 1
+        if len(operations) == BATCH_SIZE:
+            flush()
+
+    if operations:
+        flush()
+
+    logger.info(
+        f"Aggregation for summary _id {match['_id']} saw {seen} distinct IPs, {inserted} new."
+    )
+    return inserted
+
+
+def insert_enriched_ips(match, ip_index):
+    """Stream groups through the IP2Location index and insert finished documents.
+
+    IPs that already exist hit the unique index and are skipped, so enriched
+    documents from earlier runs are never rewritten.
+    """
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$ip"}},
+    ]
+
+    logger.info(f"Starting fused extract+enrich for summary _id {match['_id']}...")
+    cursor = summary_col.aggregate(pipeline, allowDiskUse=True, batchSize=BATCH_SIZE)
+
+    batch = []
+    inserted = 0
+    failed = 0
+
+    def flush():
+        nonlocal inserted, failed
+        locations = ip_index.lookup_locations(batch)
+        docs = []
+        for ip, location in zip(batch, locations):
+            if location is None:
+                docs.append({"ip": ip, "location": None, "status": "error"})
+                failed += 1
+            else:
+                docs.append({"ip": ip, "location": location, "status": "done"})
+        try:
+            inserted += len(ip_col.insert_many(docs, ordered=False).inserted_ids)
+        except errors.BulkWriteError as e:
+            if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                raise
+            inserted += e.details["nInserted"]
+        logger.info(f"Inserted {inserted} enriched IPs so far ({failed} errors)...")
         batch.clear()
 
-# Insert remaining
-if batch:
-    ip_col.insert_many(batch)
-    count += len(batch)
-    logger.info(f"Inserted final batch. Total inserted: {count}")
+    for doc in cursor:
+        batch.append(doc["_id"])
+        if len(batch) == BATCH_SIZE:
+            flush()
+
+    if batch:
+        flush()
+
+    return inserted
+
+
+def extract_distinct_ips(
+    incremental=INCREMENTAL,
+    server_merge=SERVER_MERGE,
+    partitions=PARTITIONS,
+    concurrency=CONCURRENCY,
+    fused=FUSED_ENRICH,
+):
+    high_watermark = summary_high_watermark()
+    if high_watermark is None:
+        logger.info("No summary events found.")
+        return
+
+    last_watermark = None
+    if incremental:
+        last_watermark = get_watermark(db, WATERMARK_KEY)
+    else:
+        # Clear old data
+        ip_col.drop()
+        logger.info("Dropped old 'distinct_ips' collection if it existed.")
+
+    if not incremental and not (server_merge or fused) and partitions == 1:
+        extract_count = insert_distinct_ips(
+            {**IP_MATCH, "_id": {"$lte": high_watermark}}
+        )
+        ip_col.create_index("ip", unique=True)
+    else:
+        # Upserts, $merge and fused inserts on "ip" need the unique index up front
+        ip_col.create_index("ip", unique=True)
+        if fused:
+            ip_index = IP2LocationIndex(IP2LOC_DB_PATH)
+
+            def write(match):
+                return insert_enriched_ips(match, ip_index)
+
+        elif server_merge:
+            write = merge_distinct_ips
+        else:
+            write = upsert_distinct_ips
+        id_ranges = object_id_partitions(
+            summary_col, partitions, last_watermark, high_watermark
+        )
+        logger.info(
+            f"Scanning summary in {len(id_ranges)} _id partitions, {concurrency} at a time..."
+        )
+
+        def write_partition(id_range):
+            return write({**IP_MATCH, "_id": id_range})
+
+        if server_merge and not fused:
+            extract_count = run_partitioned_merges(
+                write_partition, id_ranges, concurrency, ip_col
+            )
+        else:
+            extract_count = sum(
+                run_partitioned(write_partition, id_ranges, concurrency)
+            )
+
+    logger.info(f"Extracted {extract_count} new IPs into 'distinct_ips'.")
+    # Only advance the watermark once every IP up to it has been written
+    set_watermark(db, WATERMARK_KEY, high_watermark)
+    logger.info(f"Watermark '{WATERMARK_KEY}' set to {high_watermark}.")
+    logger.info("Done extracting distinct IPs.")
+
 
-logger.info("Done extracting distinct IPs.")
+if __name__ == "__main__":
+    extract_distinct_ips()
@@ -0,0 +1,138 @@
+import logging
+import os
+import sys
+import time
+from pymongo import MongoClient, errors
+from ip_codec import encode_ip
+
+# Logger
+os.makedirs("logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.FileHandler("logs/compact_distinct_ips.log"),
+        logging.StreamHandler(sys.stdout),
+    ],
+)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+SOURCE_COLLECTION = "distinct_ips"
+TARGET_COLLECTION = "distinct_ips_compact"
+COUNTRIES_COLLECTION = "countries"
+
+
+def compact_doc(doc, countries):
+    """Encoded IP as _id, 2-letter country code, and status only when not done"""
+    compact = {"_id": encode_ip(doc["ip"])}
+    location = doc.get("location")
+    if location:
+        code = location.get("country_code")
+        compact["cc"] = code
+        countries.setdefault(code, location.get("country_name"))
+    status = doc.get("status")
+    if status != "done":
+        compact["status"] = status
+    return compact
+
+
+def insert_batch(target, batch):
+    """Insert compact docs, skipping IPs already copied: (inserted, duplicates).
+
+    The source can hold the same IP more than once and the encoded IP is the _id,
+    so duplicate key errors (11000) are expected; any other write error is raised.
+    """
+    try:
+        return len(target.insert_many(batch, ordered=False).inserted_ids), 0
+    except errors.BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"], len(e.details["writeErrors"])
+
+
+def storage_stats(db, name):
+    stats = db.command("collStats", name)
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "storageSize": stats.get("storageSize", 0),
+        "totalIndexSize": stats.get("totalIndexSize", 0),
+    }
+
+
+def log_savings(db):
+    before = storage_stats(db, SOURCE_COLLECTION)
+    after = storage_stats(db, TARGET_COLLECTION)
+    for key in ["size", "storageSize", "totalIndexSize"]:
+        saved = 1 - after[key] / max(before[key], 1)
+        logger.info(
+            f"{key}: {before[key] / 1024**2:.1f} MB -> {after[key] / 1024**2:.1f} MB "
+            f"({saved * 100:.1f}% smaller)"
+        )
+    logger.info(
+        f"Average document size: {before['size'] / max(before['count'], 1):.0f} B -> "
+        f"{after['size'] / max(after['count'], 1):.0f} B"
+    )
+
+
+def compact_distinct_ips():
+    client = None
+    try:
+        client = MongoClient("mongodb://localhost:27017/")
+        db = client["countly"]
+        source = db[SOURCE_COLLECTION]
+        target = db[TARGET_COLLECTION]
+
+        # The compact copy is derived data, rebuild it from scratch
+        target.drop()
+        logger.info(f"Dropped old '{TARGET_COLLECTION}' collection if it existed.")
+
+        total = source.estimated_document_count()
+        logger.info(f"Compacting about {total} documents from '{SOURCE_COLLECTION}'")
+        start_time = time.time()
+
+        countries = {}
+        batch = []
+        count = 0
+        duplicates = 0
+        cursor = source.find({}, {"_id": 0, "ip": 1, "location": 1, "status": 1})
+        for doc in cursor.batch_size(BATCH_SIZE):
+            batch.append(compact_doc(doc, countries))
+            if len(batch) == BATCH_SIZE:
+                inserted, skipped = insert_batch(target, batch)
+                count += inserted
+                duplicates += skipped
+                logger.info(f"Inserted {count}/{total} compact documents...")
+                batch = []
+
+        if batch:
+            inserted, skipped = insert_batch(target, batch)
+            count += inserted
+            duplicates += skipped
+        if duplicates:
+            logger.info(f"Skipped {duplicates} duplicate IPs")
+
+        # Country names live once in a small lookup collection
+        db[COUNTRIES_COLLECTION].drop()
+        if countries:
+            db[COUNTRIES_COLLECTION].insert_many(
+                [{"_id": code, "name": name} for code, name in countries.items()]
+            )
+
+        logger.info(
+            f"Compacted {count} IPs and {len(countries)} countries in {time.time() - start_time:.2f}s"
+        )
+        log_savings(db)
+
+    except errors.PyMongoError as e:
+        logger.error(f"MongoDB error: {e}")
+    finally:
+        if client is not None:
+            client.close()
+            logger.info("MongoDB connection closed")
+
+
+if __name__ == "__main__":
+    compact_distinct_ips()
@@ -1,7 +1,13 @@
 import os
 import logging
-from pymongo import MongoClient, errors
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import bson
+from pymongo import MongoClient, UpdateOne, errors
 import IP2Location
+from ip2loc_index import IP2LocationIndex
+from mongo_utils import id_range_query, split_id_ranges
 
 # Logger
 os.makedirs("logs", exist_ok=True)
@@ -22,42 +28,168 @@ except ValueError as e:
     logger.error(f"Failed to load IP2Location DB: {e}")
     raise
 
+# Vectorized range index over the same BIN file (bulk mode lookups)
+USE_NUMPY_INDEX = True
+ip_index = None
+if USE_NUMPY_INDEX:
+    ip_index = IP2LocationIndex(db_path)
+    logger.info(
+        f"IP2Location range index loaded: {len(ip_index.v4_starts)} IPv4 ranges, "
+        f"{len(ip_index.v6_starts)} IPv6 ranges, {len(ip_index.countries)} countries."
+    )
+
+# Bulk write limits (bulk mode only)
+BULK_MAX_OPS = 1000  # Flush after this many queued updates
+BULK_MAX_BYTES = 4 * 1024 * 1024  # or once the queued updates reach ~4 MB of BSON
+
+
+# Process pool mode: one worker per _id range of pending IPs
+ENRICH_WORKERS = os.cpu_count() or 1
+
 
 # Process all pending IPs in batches
-def enrich_ip_locations(batch_size=5000):
+def enrich_ip_locations(
+    batch_size=5000, bulk_mode=True, max_ops=BULK_MAX_OPS, max_bytes=BULK_MAX_BYTES
+):
     try:
         client = MongoClient("mongodb://localhost:27017")
         db = client["countly"]
         ip_col = db["distinct_ips"]
 
-        # Fetch all pending IPs
-        cursor = ip_col.find({"status": "pending"}, {"ip": 1})
         total_ips = ip_col.count_documents(
             {"status": "pending"}
         )  # Use count_documents instead of cursor.count()
-        batch = []
+        start_time = time.time()
+
+        total_processed, total_failed = enrich_matching(
+            ip_col,
+            {"status": "pending"},
+            total_ips,
+            batch_size,
+            bulk_mode,
+            max_ops,
+            max_bytes,
+        )
+
+        duration = time.time() - start_time
+        logger.info(
+            f"Enrichment completed. Total processed: {total_processed}, Failed: {total_failed}"
+        )
+        logger.info(
+            f"Mode: {'bulk' if bulk_mode else 'per-document'} | Duration: {duration:.2f}s | "
+            f"Average speed: {(total_processed + total_failed) / max(duration, 1e-6):.0f} IPs/sec"
+        )
+
+    except errors.ConnectionFailure as e:
+        logger.error(f"MongoDB connection error: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+
+
+def enrich_matching(
+    ip_col,
+    query,
+    total_ips,
+    batch_size=5000,
+    bulk_mode=True,
+    max_ops=BULK_MAX_OPS,
+    max_bytes=BULK_MAX_BYTES,
+):
+    """Walk the IPs matching query in batches and enrich them"""
+    cursor = ip_col.find(query, {"ip": 1})
+    batch = []
+    total_processed = 0
+    total_failed = 0
+
+    def run_batch(batch):
+        if bulk_mode:
+            return process_batch_bulk(batch, ip_col, max_ops, max_bytes)
+        return process_batch(batch, ip_col)
+
+    for ip_doc in cursor:
+        batch.append(ip_doc)
+        if len(batch) >= batch_size:
+            processed, failed = run_batch(batch)
+            total_processed += processed
+            total_failed += failed
+            logger.info(f"Progress: {total_processed}/{total_ips} IPs processed.")
+            batch = []
+
+    # Process any remaining IPs
+    if batch:
+        processed, failed = run_batch(batch)
+        total_processed += processed
+        total_failed += failed
+        logger.info(f"Progress: {total_processed}/{total_ips} IPs processed.")
+
+    return total_processed, total_failed
+
+
+def init_worker():
+    """Forked workers must not share the parent's file offset or Mongo sockets"""
+    global ip2loc
+    if ip_index is None:
+        ip2loc = IP2Location.IP2Location(db_path)
+
+
+def enrich_id_range(lower, upper, count, batch_size=5000):
+    """Worker entry point: enrich the pending IPs with lower <= _id < upper"""
+    client = MongoClient("mongodb://localhost:27017")
+    try:
+        ip_col = client["countly"]["distinct_ips"]
+        query = id_range_query({"status": "pending"}, lower, upper)
+        logger.info(
+            f"[pid {os.getpid()}] Enriching {count} IPs in _id range [{lower}, {upper})"
+        )
+        return enrich_matching(ip_col, query, count, batch_size)
+    finally:
+        client.close()
+
+
+def enrich_ip_locations_parallel(workers=ENRICH_WORKERS, batch_size=5000):
+    """Split pending IPs into _id ranges and enrich each range in its own process.
+
+    Workers are forked after the range index is built, so they all read the same
+    memory-mapped BIN file instead of loading a private copy each.
+    """
+    try:
+        client = MongoClient("mongodb://localhost:27017")
+        ip_col = client["countly"]["distinct_ips"]
+        id_ranges = split_id_ranges(ip_col, workers, {"status": "pending"})
+        # Close the parent's pooled sockets before forking
+        client.close()
+
+        total_ips = sum(count for _, _, count in id_ranges)
+        logger.info(
+            f"Enriching {total_ips} pending IPs with {workers} workers over {len(id_ranges)} _id ranges"
+        )
+        start_time = time.time()
         total_processed = 0
         total_failed = 0
 
-        for ip_doc in cursor:
-            batch.append(ip_doc)
-            if len(batch) >= batch_size:
-                processed, failed = process_batch(batch, ip_col)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+        ) as executor:
+            futures = [
+                executor.submit(enrich_id_range, lower, upper, count, batch_size)
+                for lower, upper, count in id_ranges
+            ]
+            for future in as_completed(futures):
+                processed, failed = future.result()
                 total_processed += processed
                 total_failed += failed
                 logger.info(f"Progress: {total_processed}/{total_ips} IPs processed.")
-                batch = []
-
-        # Process any remaining IPs
-        if batch:
-            processed, failed = process_batch(batch, ip_col)
-            total_processed += processed
-            total_failed += failed
-            logger.info(f"Progress: {total_processed}/{total_ips} IPs processed.")
 
+        duration = time.time() - start_time
         logger.info(
             f"Enrichment completed. Total processed: {total_processed}, Failed: {total_failed}"
         )
+        logger.info(
+            f"Mode: {workers} processes | Duration: {duration:.2f}s | "
+            f"Average speed: {(total_processed + total_failed) / max(duration, 1e-6):.0f} IPs/sec"
+        )
 
     except errors.ConnectionFailure as e:
         logger.error(f"MongoDB connection error: {e}")
@@ -65,20 +197,42 @@ def enrich_ip_locations(batch_size=5000):
         logger.error(f"Unexpected error: {e}")
 
 
+def lookup_location(ip):
+    record = ip2loc.get_all(ip)
+    return {
+        "country_code": record.country_short,
+        "country_name": record.country_long,
+    }
+
+
+def lookup_locations(ips):
+    """Resolve a whole batch of IPs, None marks an IP that could not be enriched"""
+    if ip_index is not None:
+        locations = ip_index.lookup_locations(ips)
+        for ip, location in zip(ips, locations):
+            if location is None:
+                logger.error(f"Failed to enrich IP {ip}: no matching range")
+        return locations
+
+    locations = []
+    for ip in ips:
+        try:
+            locations.append(lookup_location(ip))
+        except Exception as e:
+            logger.error(f"Failed to enrich IP {ip}: {e}")
+            locations.append(None)
+    return locations
+
+
 def process_batch(batch, ip_col):
+    """Per-document path: one update_one round trip per IP"""
     processed = 0
     failed = 0
+    start_time = time.time()
     for ip_doc in batch:
         ip = ip_doc["ip"]
         try:
-            record = ip2loc.get_all(ip)
-            update = {
-                "location": {
-                    "country_code": record.country_short,
-                    "country_name": record.country_long,
-                },
-                "status": "done",
-            }
+            update = {"location": lookup_location(ip), "status": "done"}
             ip_col.update_one({"_id": ip_doc["_id"]}, {"$set": update})
             processed += 1
         except Exception as e:
@@ -86,11 +240,69 @@ def process_batch(batch, ip_col):
             ip_col.update_one({"_id": ip_doc["_id"]}, {"$set": {"status": "error"}})
             failed += 1
 
+    elapsed = time.time() - start_time
+    logger.info(
+        f"Processed batch of {len(batch)}. Success: {processed}, Failed: {failed} "
+        f"({elapsed:.2f}s, {len(batch) / max(elapsed, 1e-6):.0f} IPs/sec)"
+    )
+    return processed, failed
+
+
+def process_batch_bulk(batch, ip_col, max_ops=BULK_MAX_OPS, max_bytes=BULK_MAX_BYTES):
+    """Bulk path: queue updates and flush them as unordered bulk_write calls"""
+    processed = 0
+    failed = 0
+    start_time = time.time()
+    operations = []
+    pending_bytes = 0
+    pending_failed = 0
+
+    def flush():
+        nonlocal processed, failed, operations, pending_bytes, pending_failed
+        try:
+            ip_col.bulk_write(operations, ordered=False)
+            processed += len(operations) - pending_failed
+            failed += pending_failed
+        except errors.BulkWriteError as e:
+            write_errors = len(e.details.get("writeErrors", []))
+            logger.error(
+                f"Bulk write had {write_errors} errors, first: {e.details['writeErrors'][:1]}"
+            )
+            processed += len(operations) - pending_failed - write_errors
+            failed += pending_failed + write_errors
+        operations = []
+        pending_bytes = 0
+        pending_failed = 0
+
+    locations = lookup_locations([ip_doc["ip"] for ip_doc in batch])
+
+    for ip_doc, location in zip(batch, locations):
+        if location is not None:
+            update = {"location": location, "status": "done"}
+        else:
+            update = {"status": "error"}
+            pending_failed += 1
+
+        selector = {"_id": ip_doc["_id"]}
+        operations.append(UpdateOne(selector, {"$set": update}))
+        pending_bytes += len(bson.encode(selector)) + len(bson.encode(update))
+
+        if len(operations) >= max_ops or pending_bytes >= max_bytes:
+            flush()
+
+    if operations:
+        flush()
+
+    elapsed = time.time() - start_time
     logger.info(
-        f"Processed batch of {len(batch)}. Success: {processed}, Failed: {failed}"
+        f"Processed batch of {len(batch)} (bulk). Success: {processed}, Failed: {failed} "
+        f"({elapsed:.2f}s, {len(batch) / max(elapsed, 1e-6):.0f} IPs/sec)"
     )
     return processed, failed
 
 
 if __name__ == "__main__":
-    enrich_ip_locations()
+    if ENRICH_WORKERS > 1:
+        enrich_ip_locations_parallel()
+    else:
+        enrich_ip_locations()
@@ -1,9 +1,20 @@
 import logging
 import os
 from pymongo import MongoClient
-from pymongo import UpdateOne
+from pymongo import UpdateOne, errors
 import sys
+import time
 from tqdm import tqdm
+from mongo_utils import (
+    get_watermark,
+    merge_stage,
+    object_id_partitions,
+    retry_on_duplicate_key,
+    run_merge_pipeline,
+    run_partitioned,
+    run_partitioned_merges,
+    set_watermark,
+)
 
 # Logger
 os.makedirs("logs", exist_ok=True)
@@ -20,8 +31,141 @@ logger = logging.getLogger(__name__)
 
 BATCH_SIZE = 5000  # Process documents in batches of 5000
 
+PRODUCT_COLLECTIONS = [
+    "view_product_detail",
+    "select_product_option",
+    "select_product_option_quality",
+]
+PRODUCT_MATCH = {
+    "collection": {"$in": PRODUCT_COLLECTIONS},
+    "product_id": {"$exists": True, "$ne": ""},
+}
+
+# Server-side mode: end the pipeline with $merge so MongoDB writes product_names
+# itself instead of round-tripping every product through UpdateOne upserts
+SERVER_MERGE = False
+
+# Partitioned scan: split summary into PARTITIONS ObjectId time ranges and run the
+# group pipeline on up to CONCURRENCY of them at once (1 = single aggregation)
+PARTITIONS = 1
+CONCURRENCY = 4
+
+# Watch mode: keep product_names (and every crawled name) and only upsert products
+# from summary events newer than the watermark, running until interrupted.
+# Change streams need a replica set (a single-node one is enough); on a standalone
+# server the watcher falls back to polling summary every WATCH_POLL_INTERVAL seconds
+WATCH_MODE = False
+USE_CHANGE_STREAM = True
+WATCH_POLL_INTERVAL = 30
+# Watermark shared with 1.1.extract-ips-and-products.py
+WATERMARK_KEY = "product_names.summary_id"
+RESUME_TOKEN_KEY = "product_names.resume_token"
+
+# Server error codes: change streams unavailable on a standalone server, and a
+# resume token that has already rolled off the oplog
+CHANGE_STREAM_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def build_pipeline(match):
+    return [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": "$product_id",
+                "current_url": {"$first": "$current_url"},
+            }
+        },
+        {"$project": {"product_id": "$_id", "current_url": 1, "_id": 0}},
+    ]
+
+
+def merge_product_names(source_collection, target_collection, pipeline):
+    """Run the product pipeline with a $merge into product_names"""
+    merge_pipeline = pipeline[:-1] + [
+        {
+            "$project": {
+                "_id": 0,
+                "product_id": "$_id",
+                "current_url": 1,
+                "product_name": {"$literal": None},
+                "status": {"$literal": "pending"},
+            }
+        },
+        merge_stage(target_collection, "product_id"),
+    ]
+    return retry_on_duplicate_key(
+        lambda: run_merge_pipeline(source_collection, merge_pipeline, target_collection)
+    )
+
+
+def product_upsert(product_id, current_url):
+    """Insert product_id as pending, leaving an existing document untouched"""
+    return UpdateOne(
+        {"product_id": product_id},
+        {
+            "$setOnInsert": {
+                "product_id": product_id,
+                "current_url": current_url,
+                "product_name": None,
+                "status": "pending",
+            }
+        },
+        upsert=True,
+    )
+
+
+def upsert_product_names(source_collection, target_collection, pipeline, pbar=None):
+    """Stream distinct products to the client and upsert them as pending"""
+    # Execute aggregation with cursor
+    cursor = source_collection.aggregate(
+        pipeline, allowDiskUse=True, batchSize=BATCH_SIZE
+    )
+
+    # Initialize batch processing
+    operations = []
+    processed_count = 0
+
+    for doc in cursor:
+        try:
+            product_id = doc["product_id"]
+            current_url = doc.get("current_url", "")
 
-def create_product_name_collection():
+            if not product_id:
+                continue
+
+            # Prepare bulk operation
+            operations.append(product_upsert(product_id, current_url))
+
+            # Execute batch when reaching batch size
+            if len(operations) == BATCH_SIZE:
+                result = retry_on_duplicate_key(
+                    lambda: target_collection.bulk_write(operations, ordered=False)
+                )
+                processed_count += result.upserted_count
+                operations = []
+                if pbar is not None:
+                    pbar.update(BATCH_SIZE)
+
+        except Exception as e:
+            logger.error(f"Error processing document {doc.get('_id')}: {str(e)}")
+            continue
+
+    # Process remaining operations in final batch
+    if operations:
+        result = retry_on_duplicate_key(
+            lambda: target_collection.bulk_write(operations, ordered=False)
+        )
+        processed_count += result.upserted_count
+        if pbar is not None:
+            pbar.update(len(operations))
+
+    return processed_count
+
+
+def create_product_name_collection(
+    server_merge=SERVER_MERGE, partitions=PARTITIONS, concurrency=CONCURRENCY
+):
     try:
         # MongoDB connection
         try:
@@ -42,108 +186,66 @@ def create_product_name_collection():
         source_collection = db["summary"]
         target_collection = db["product_names"]
 
-        # Define the aggregation pipeline
-        pipeline = [
-            {
-                "$match": {
-                    "collection": {
-                        "$in": [
-                            "view_product_detail",
-                            "select_product_option",
-                            "select_product_option_quality",
-                        ]
-                    },
-                    "product_id": {"$exists": True, "$ne": ""},
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$product_id",
-                    "current_url": {"$first": "$current_url"},
-                }
-            },
-            {"$project": {"product_id": "$_id", "current_url": 1, "_id": 0}},
-        ]
-
-        # Get estimated count for progress bar
-        estimated_count = source_collection.count_documents(
-            {
-                "collection": {
-                    "$in": [
-                        "view_product_detail",
-                        "select_product_option",
-                        "select_product_option_quality",
-                    ]
-                },
-                "product_id": {"$exists": True, "$ne": ""},
-            }
-        )
+        # Collection metadata only: a count_documents with the product filter would
+        # cost a second full scan of summary before the aggregation even starts
+        estimated_count = source_collection.estimated_document_count()
 
         logger.info(
-            f"Processing estimated {estimated_count} documents to find distinct product IDs"
+            f"Scanning about {estimated_count} summary documents to find distinct product IDs"
         )
 
-        # Execute aggregation with cursor
-        cursor = source_collection.aggregate(
-            pipeline, allowDiskUse=True, batchSize=BATCH_SIZE
-        )
+        # Upserts and $merge on "product_id" need the unique index up front
+        target_collection.create_index("product_id", unique=True)
+        logger.info("Created unique index on product_id")
 
-        # Initialize batch processing
-        operations = []
-        processed_count = 0
+        # Newest summary event before the scan, so watch mode resumes right after it
+        newest = source_collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        high_watermark = newest["_id"] if newest else None
 
-        with tqdm(desc="Processing distinct products", unit="product") as pbar:
-            for doc in cursor:
-                try:
-                    product_id = doc["product_id"]
-                    current_url = doc.get("current_url", "")
-
-                    if not product_id:
-                        continue
-
-                    # Prepare bulk operation
-                    operations.append(
-                        UpdateOne(
-                            {"product_id": product_id},
-                            {
-                                "$setOnInsert": {
-                                    "product_id": product_id,
-                                    "current_url": current_url,
-                                    "product_name": None,
-                                    "status": "pending",
-                                }
-                            },
-                            upsert=True,
-                        )
-                    )
+        if partitions > 1:
+            id_ranges = object_id_partitions(
+                source_collection, partitions, upper=high_watermark
+            )
+            logger.info(
+                f"Scanning summary in {len(id_ranges)} _id partitions, {concurrency} at a time"
+            )
+        else:
+            id_ranges = [{"$lte": high_watermark}] if high_watermark else [None]
 
-                    # Execute batch when reaching batch size
-                    if len(operations) == BATCH_SIZE:
-                        result = target_collection.bulk_write(operations, ordered=False)
-                        processed_count += result.upserted_count
-                        operations = []
-                        pbar.update(BATCH_SIZE)
+        with tqdm(desc="Processing distinct products", unit="product") as pbar:
 
-                except Exception as e:
-                    logger.error(
-                        f"Error processing document {doc.get('_id')}: {str(e)}"
+            def extract(id_range):
+                match = (
+                    PRODUCT_MATCH
+                    if id_range is None
+                    else {**PRODUCT_MATCH, "_id": id_range}
+                )
+                pipeline = build_pipeline(match)
+                if server_merge:
+                    return merge_product_names(
+                        source_collection, target_collection, pipeline
                     )
-                    continue
+                return upsert_product_names(
+                    source_collection, target_collection, pipeline, pbar
+                )
 
-            # Process remaining operations in final batch
-            if operations:
-                result = target_collection.bulk_write(operations, ordered=False)
-                processed_count += result.upserted_count
-                pbar.update(len(operations))
+            if server_merge:
+                added = run_partitioned_merges(
+                    extract, id_ranges, concurrency, target_collection
+                )
+            else:
+                added = sum(run_partitioned(extract, id_ranges, concurrency))
+
+        logger.info(f"Added {added} distinct products")
 
         # Get actual distinct count (more accurate than processed_count due to upserts)
         distinct_count = target_collection.count_documents({})
         logger.info(f"Successfully processed {distinct_count} distinct products")
         logger.info(f"Final collection count: {distinct_count}")
 
-        # Create index on product_id
-        target_collection.create_index("product_id", unique=True)
-        logger.info("Created unique index on product_id")
+        if high_watermark is not None:
+            set_watermark(db, WATERMARK_KEY, high_watermark)
+            logger.info(f"Watermark '{WATERMARK_KEY}' set to {high_watermark}")
 
     except Exception as e:
         logger.critical(f"Script failed: {str(e)}", exc_info=True)
@@ -154,5 +256,130 @@ def create_product_name_collection():
             logger.info("MongoDB connection closed")
 
 
+def catch_up_product_names(db, source_collection, target_collection):
+    """Upsert products from summary events newer than the watermark, then advance it"""
+    newest = source_collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    last_watermark = get_watermark(db, WATERMARK_KEY)
+    if newest is None or (last_watermark and newest["_id"] <= last_watermark):
+        return 0
+
+    id_range = {"$lte": newest["_id"]}
+    if last_watermark is not None:
+        id_range["$gt"] = last_watermark
+    pipeline = build_pipeline({**PRODUCT_MATCH, "_id": id_range})
+    added = upsert_product_names(source_collection, target_collection, pipeline)
+
+    set_watermark(db, WATERMARK_KEY, newest["_id"])
+    if added:
+        logger.info(f"Added {added} new products up to summary _id {newest['_id']}")
+    return added
+
+
+def poll_product_names(db, source_collection, target_collection, poll_interval):
+    """Catch up on the _id watermark every poll_interval seconds"""
+    logger.info(f"Polling summary for new products every {poll_interval}s")
+    while True:
+        catch_up_product_names(db, source_collection, target_collection)
+        time.sleep(poll_interval)
+
+
+def stream_product_names(db, source_collection, target_collection, poll_interval):
+    """Tail inserts into summary through a change stream and upsert new products"""
+    pipeline = [
+        {
+            "$match": {
+                "operationType": "insert",
+                "fullDocument.collection": {"$in": PRODUCT_COLLECTIONS},
+                "fullDocument.product_id": {"$exists": True, "$ne": ""},
+            }
+        }
+    ]
+    resume_token = get_watermark(db, RESUME_TOKEN_KEY)
+
+    with source_collection.watch(
+        pipeline,
+        resume_after=resume_token,
+        max_await_time_ms=poll_interval * 1000,
+    ) as stream:
+        # The stream is open before catching up, so events inserted in between are
+        # seen twice at worst, and the upserts make that harmless
+        if resume_token is None:
+            catch_up_product_names(db, source_collection, target_collection)
+        logger.info("Watching summary change stream for new products")
+
+        operations = []
+        newest_id = None
+        while stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                doc = change["fullDocument"]
+                operations.append(
+                    product_upsert(doc["product_id"], doc.get("current_url", ""))
+                )
+                newest_id = doc["_id"]
+                if len(operations) < BATCH_SIZE:
+                    continue
+            elif not operations:
+                continue
+
+            result = retry_on_duplicate_key(
+                lambda: target_collection.bulk_write(operations, ordered=False)
+            )
+            if result.upserted_count:
+                logger.info(f"Added {result.upserted_count} new products")
+            operations = []
+            set_watermark(db, RESUME_TOKEN_KEY, stream.resume_token)
+            set_watermark(db, WATERMARK_KEY, newest_id)
+
+
+def watch_product_names(
+    use_change_stream=USE_CHANGE_STREAM, poll_interval=WATCH_POLL_INTERVAL
+):
+    """Keep product_names in sync with summary until interrupted, without dropping it"""
+    client = None
+    try:
+        client = MongoClient("mongodb://localhost:27017/")
+        client.admin.command("ping")
+        db = client["countly"]
+        logger.info("Successfully connected to MongoDB")
+
+        source_collection = db["summary"]
+        target_collection = db["product_names"]
+        target_collection.create_index("product_id", unique=True)
+
+        while use_change_stream:
+            try:
+                stream_product_names(
+                    db, source_collection, target_collection, poll_interval
+                )
+            except errors.OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # Token is older than the oplog: catch up on the _id watermark instead
+                    logger.warning("Resume token expired, restarting change stream")
+                    set_watermark(db, RESUME_TOKEN_KEY, None)
+                elif e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.warning(
+                        "Change streams need a replica set, falling back to polling"
+                    )
+                    use_change_stream = False
+                else:
+                    raise
+
+        poll_product_names(db, source_collection, target_collection, poll_interval)
+
+    except KeyboardInterrupt:
+        logger.info("Watch mode stopped")
+    except Exception as e:
+        logger.critical(f"Script failed: {str(e)}", exc_info=True)
+        raise
+    finally:
+        if client is not None:
+            client.close()
+            logger.info("MongoDB connection closed")
+
+
 if __name__ == "__main__":
-    create_product_name_collection()
+    if WATCH_MODE:
+        watch_product_names()
+    else:
+        create_product_name_collection()
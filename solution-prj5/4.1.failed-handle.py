@@ -1,11 +1,15 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
 from pymongo import MongoClient
 import logging
+from collections import Counter
 from datetime import datetime
 import os
 import csv
 import time
+from page_archive import PageArchive
+from crawl_http import declared_charset
+from product_extract import SELECTOR_NAMES, extract_page, extract_product_name
 
 # Logger
 os.makedirs("logs", exist_ok=True)
@@ -20,6 +24,8 @@ logging.basicConfig(
     ],
 )
 logger = logging.getLogger(__name__)
+# Per-page "Found name" lines would drown the summary
+logging.getLogger("product_extract").setLevel(logging.ERROR)
 
 # Configuration
 TIMEOUT = 10
@@ -28,6 +34,27 @@ HEADERS = {
     "Accept-Language": "en-US,en;q=0.9",
 }
 OUTPUT_FILE = f"failed_errors_{timestamp}.csv"
+# The crawler saves a failure reason on every failed doc; docs failed before it did
+# are diagnosed from the crawler's page archive when it holds the URL
+USE_ARCHIVE = True
+ARCHIVE_DIR = "page_archive"
+# Live re-probing (off by default): refetch the failed docs matching REPROBE_FILTER,
+# REPROBE_CONCURRENCY requests at a time, and report what the sites return now
+REPROBE = False
+REPROBE_FILTER = {"failure": {"$exists": False}}
+REPROBE_CONCURRENCY = 32
+
+CSV_FIELDS = [
+    "product_id",
+    "url",
+    "error type",
+    "http_status",
+    "exception",
+    "elapsed",
+    "selectors_tried",
+    "failed_at",
+    "source",
+]
 
 
 def get_mongo_collection():
@@ -40,50 +67,113 @@ def get_mongo_collection():
         raise
 
 
-def diagnose_error(url, product_id):
+def failure_rows(collection):
+    """One CSV row per failed doc, from the failure saved by the crawler"""
+    pipeline = [
+        {"$match": {"status": "failed"}},
+        {
+            "$project": {
+                "_id": 0,
+                "product_id": 1,
+                "url": {"$ifNull": ["$current_url", ""]},
+                "canonical_url": 1,
+                "error type": {"$ifNull": ["$failure.reason", None]},
+                "http_status": "$failure.http_status",
+                "exception": "$failure.exception",
+                "elapsed": "$failure.elapsed",
+                "selectors_tried": "$failure.selectors_tried",
+                "failed_at": "$failure.failed_at",
+            }
+        },
+        {"$sort": {"error type": 1, "product_id": 1}},
+    ]
+    return collection.aggregate(pipeline, allowDiskUse=True)
+
+
+def diagnose_archived(record, archive):
+    """Diagnose from the last archived response of a URL, without refetching"""
+    if record["status"] >= 400:
+        return {
+            "error type": f"HTTP {record['status']}",
+            "http_status": record["status"],
+        }
     try:
-        logger.info(f"Diagnosing: {product_id} - {url}")
-        response = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-        response.raise_for_status()
+        body = archive.read_body(record["sha256"])
+    except OSError as e:
+        return {
+            "error type": "Archive missing",
+            "http_status": record["status"],
+            "exception": type(e).__name__,
+        }
+    # Decode as the crawler did: archived headers keep the server's casing
+    headers = {key.title(): value for key, value in record["headers"].items()}
+    _, success, _ = extract_page(
+        body, declared_charset(headers), "archived", record["product_id"], record["url"]
+    )
+    if success:
+        return {"error type": "No error", "http_status": record["status"]}
+    return {
+        "error type": "No selectors matched",
+        "http_status": record["status"],
+        "selectors_tried": SELECTOR_NAMES,
+    }
 
-        # Try lxml parser, fall back to html.parser
+
+async def diagnose_error(session, semaphore, url, product_id):
+    """Refetch one URL and diagnose it, in the crawler's failure categories"""
+    async with semaphore:
+        start = time.perf_counter()
         try:
-            soup = BeautifulSoup(response.text, "lxml")
-        except Exception:
-            soup = BeautifulSoup(response.text, "html.parser")
-            logger.warning(f"lxml unavailable for {product_id}, using html.parser")
-
-        selectors = [
-            {"name": "h1", "class": "product-name"},
-            {"class": "product-title"},
-            {"class": "product_title"},
-            {"name": "h1"},
-        ]
-
-        for selector in selectors:
-            element = (
-                soup.find(**selector)
-                if isinstance(selector, dict)
-                else soup.find(selector)
+            async with session.get(url) as response:
+                body = await response.read()
+                status = response.status
+        except asyncio.TimeoutError as e:
+            reason, exception, status = "Timeout", e, None
+        except aiohttp.ClientConnectionError as e:
+            reason, exception, status = "Connection error", e, None
+        except aiohttp.ClientError as e:
+            reason, exception, status = "Request error", e, None
+        else:
+            exception = None
+        elapsed = time.perf_counter() - start
+
+    diagnosis = {"elapsed": elapsed, "http_status": status}
+    if exception is not None:
+        return {
+            **diagnosis,
+            "error type": reason,
+            "exception": type(exception).__name__,
+        }
+    if status >= 400:
+        return {**diagnosis, "error type": f"HTTP {status}"}
+    _, success, _ = extract_product_name(body, product_id, "reprobe", url)
+    if success:
+        return {**diagnosis, "error type": "No error"}
+    return {
+        **diagnosis,
+        "error type": "No selectors matched",
+        "selectors_tried": SELECTOR_NAMES,
+    }
+
+
+async def reprobe(docs):
+    """Diagnose docs live with bounded concurrency: {product_id: diagnosis}"""
+    semaphore = asyncio.Semaphore(REPROBE_CONCURRENCY)
+    async with aiohttp.ClientSession(
+        headers=HEADERS, timeout=aiohttp.ClientTimeout(total=TIMEOUT)
+    ) as session:
+        diagnoses = await asyncio.gather(
+            *(
+                diagnose_error(
+                    session, semaphore, doc["current_url"], doc["product_id"]
+                )
+                for doc in docs
             )
-            if element and element.get_text(strip=True):
-                logger.info(f"Found name for {product_id}, no error")
-                return "No error"
-        return "No selectors matched"
-
-    except requests.exceptions.HTTPError as e:
-        return f"HTTP {response.status_code}"
-    except requests.exceptions.Timeout:
-        return "Timeout"
-    except requests.exceptions.ConnectionError:
-        return "Connection error"
-    except requests.exceptions.RequestException as e:
-        return f"Request error: {str(e)}"
-    except Exception as e:
-        return f"Unexpected error: {str(e)}"
+        )
+    return {doc["product_id"]: diagnosis for doc, diagnosis in zip(docs, diagnoses)}
 
 
-def analyze_failed_documents():
+def analyze_failed_documents(reprobe_docs=REPROBE, reprobe_filter=REPROBE_FILTER):
     client = None
     try:
         logger.info("=== Starting analysis of failed documents ===")
@@ -98,29 +188,69 @@ def analyze_failed_documents():
             logger.info("No failed documents to analyze")
             return
 
-        cursor = collection.find({"status": "failed"})
+        reprobed = {}
+        if reprobe_docs:
+            docs = list(
+                collection.find(
+                    {
+                        "$and": [
+                            {"status": "failed"},
+                            {"current_url": {"$nin": [None, ""]}},
+                            reprobe_filter,
+                        ]
+                    },
+                    {"product_id": 1, "current_url": 1},
+                )
+            )
+            logger.info(f"Re-probing {len(docs)} URLs, {REPROBE_CONCURRENCY} at a time")
+            reprobed = asyncio.run(reprobe(docs))
 
+        archive = None
+        archived = {}
+        if USE_ARCHIVE and os.path.isdir(ARCHIVE_DIR):
+            archive = PageArchive(ARCHIVE_DIR)
+            archived = {record["url"]: record for record in archive.latest_records()}
+            logger.info(f"Page archive holds {len(archived)} URLs")
+
+        error_types = Counter()
+        sources = Counter()
         # Prepare CSV output
         with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["product_id", "url", "error type"])
-
-            for doc in cursor:
-                product_id = doc["product_id"]
-                url = doc.get("current_url", "")
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
+            writer.writeheader()
 
-                if not url:
-                    error_type = "Missing URL"
-                    logger.warning(f"No URL for {product_id}")
+            for row in failure_rows(collection):
+                product_id = row["product_id"]
+                url = row["url"]
+                # The crawler archives pages under their canonical URL
+                archive_key = row.pop("canonical_url", None)
+                if archive_key not in archived:
+                    archive_key = url
+                if product_id in reprobed:
+                    row.update(reprobed[product_id], source="reprobe")
+                elif row["error type"] is not None:
+                    row["source"] = "crawler"
+                elif not url:
+                    row.update({"error type": "Missing URL"}, source="crawler")
+                elif archive_key in archived:
+                    row.update(
+                        diagnose_archived(archived[archive_key], archive),
+                        source="archive",
+                    )
                 else:
-                    error_type = diagnose_error(url, product_id)
-                    logger.info(f"Error for {product_id}: {error_type}")
+                    row.update({"error type": "Unknown"}, source="none")
 
-                writer.writerow([product_id, url, error_type])
+                row["selectors_tried"] = ",".join(row.get("selectors_tried") or [])
+                error_types[row["error type"]] += 1
+                sources[row["source"]] += 1
+                writer.writerow(row)
 
         duration = time.time() - start_time
         logger.info("=== Analysis completed ===")
-        logger.info(f"Total analyzed: {total_failed}")
+        logger.info(f"Total analyzed: {sum(error_types.values())}")
+        for error_type, count in error_types.most_common():
+            logger.info(f"{error_type}: {count}")
+        logger.info(f"Diagnosis sources: {dict(sources)}")
         logger.info(f"Output written to: {OUTPUT_FILE}")
         logger.info(f"Total duration: {duration:.2f} seconds")
 
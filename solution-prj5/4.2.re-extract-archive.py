@@ -0,0 +1,139 @@
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pymongo import MongoClient, UpdateMany
+from page_archive import PageArchive
+from crawl_http import declared_charset
+from product_extract import extract_page
+
+# Logger
+os.makedirs("logs", exist_ok=True)
+
+timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.FileHandler(f"logs/re_extract_archive_{timestamp}.log"),
+        logging.StreamHandler(),
+    ],
+)
+logger = logging.getLogger(__name__)
+# Per-page "Found name" lines would drown the summary
+logging.getLogger("product_extract").setLevel(logging.ERROR)
+
+# Configuration
+ARCHIVE_DIR = "page_archive"
+WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 64  # Records handed to a worker at a time
+OUTPUT_FILE = f"re_extract_{timestamp}.csv"
+# Write names found in the archive back to product_names (status processed)
+UPDATE_DB = False
+BATCH_SIZE = 1000
+
+archive = PageArchive(ARCHIVE_DIR)
+
+
+def re_extract(record):
+    """Rerun the name selectors on one archived page, no network involved"""
+    if record["status"] >= 400:
+        return record, None, f"HTTP {record['status']}"
+    try:
+        body = archive.read_body(record["sha256"])
+    except OSError as e:
+        return record, None, f"Missing body: {str(e)}"
+    # Decode as the crawler did: archived headers are a plain dict in the server's
+    # casing, where the crawler read them case-insensitively
+    headers = {key.title(): value for key, value in record["headers"].items()}
+    product_name, success, _ = extract_page(
+        body,
+        declared_charset(headers),
+        f"archived HTTP {record['status']}",
+        record["product_id"],
+        record["url"],
+    )
+    return record, product_name, "No error" if success else "No selectors matched"
+
+
+def update_product_names(results):
+    client = MongoClient("mongodb://localhost:27017/")
+    try:
+        collection = client["countly"]["product_names"]
+        operations = [
+            # The crawler fetches each canonical URL once for every product on it
+            UpdateMany(
+                {
+                    "$or": [
+                        {"product_id": record["product_id"]},
+                        {"canonical_url": record["url"]},
+                    ]
+                },
+                # Clear what a crawler success clears: the saved failure, the retry
+                # schedule and any lease still held on the doc
+                {
+                    "$set": {"product_name": product_name, "status": "processed"},
+                    "$unset": {
+                        "failure": "",
+                        "next_attempt_at": "",
+                        "worker_id": "",
+                        "claim_id": "",
+                        "lease_expires_at": "",
+                    },
+                },
+            )
+            for record, product_name, _ in results
+            if product_name
+        ]
+        for i in range(0, len(operations), BATCH_SIZE):
+            result = collection.bulk_write(
+                operations[i : i + BATCH_SIZE], ordered=False
+            )
+            logger.info(f"Updated {result.modified_count} product_names documents")
+    finally:
+        client.close()
+
+
+def re_extract_archive(workers=WORKERS, update_db=UPDATE_DB):
+    start_time = time.time()
+    records = archive.latest_records()
+    logger.info(f"Re-extracting {len(records)} archived pages with {workers} workers")
+
+    results = []
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(
+        OUTPUT_FILE, "w", newline="", encoding="utf-8"
+    ) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["product_id", "url", "fetched_at", "product_name", "result"])
+        for record, product_name, outcome in executor.map(
+            re_extract, records, chunksize=CHUNK_SIZE
+        ):
+            writer.writerow(
+                [
+                    record["product_id"],
+                    record["url"],
+                    record["fetched_at"],
+                    product_name or "",
+                    outcome,
+                ]
+            )
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            results.append((record, product_name, outcome))
+
+    duration = time.time() - start_time
+    logger.info(f"Results: {outcomes}")
+    logger.info(
+        f"Re-extracted {len(records)} pages in {duration:.2f}s "
+        f"({len(records) / max(duration, 1e-9):.1f} pages/second)"
+    )
+    logger.info(f"Output written to: {OUTPUT_FILE}")
+
+    if update_db:
+        update_product_names(results)
+
+
+if __name__ == "__main__":
+    re_extract_archive()
@@ -1,19 +1,50 @@
+import asyncio
+import aiohttp
 import requests
-from bs4 import BeautifulSoup
 from pymongo import MongoClient, UpdateOne
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import random
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import psutil
+from contextlib import nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor
+import queue
 import threading
 import os
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+import socket
+import uuid
 import importlib.util
 from tqdm import tqdm
+from crawl_control import (
+    AimdLimiter,
+    AsyncDomainGate,
+    DomainGate,
+    RequestSlot,
+    RetryScheduler,
+    parse_retry_after,
+    url_domain,
+)
+from crawl_http import (
+    ACCEPT_ENCODING,
+    DNS_CACHE_TTL,
+    conditional_headers,
+    declared_charset,
+    get_session,
+    install_dns_cache,
+    response_validators,
+    set_timing_observer,
+)
+from crawl_metrics import CrawlMetrics, serve_metrics
+from crawl_telemetry import SystemMetricsSampler, queue_logging
+from page_archive import PageArchive
+from url_canonical import canonical_url, load_redirects, redirect_upsert
+from product_extract import NO_PARSER, SELECTOR_NAMES, timed_extract_page
 
 # Logger
 os.makedirs("logs", exist_ok=True)
+# Share of the per-URL INFO/DEBUG lines (crawl.urls, product_extract) that are kept;
+# warnings and errors are always logged
+LOG_SAMPLE_RATE = 0.01
 
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(
@@ -25,6 +56,7 @@ logging.basicConfig(
     ],
 )
 logger = logging.getLogger(__name__)
+url_logger = logging.getLogger("crawl.urls")
 
 # Configure summary logger
 summary_logger = logging.getLogger("summary")
@@ -33,16 +65,79 @@ summary_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
 summary_logger.addHandler(summary_handler)
 summary_logger.setLevel(logging.INFO)
 
+# Handlers run on listener threads: a logging call in the crawl only queues the record
+queue_logging(logging.getLogger(), LOG_SAMPLE_RATE, ["crawl.urls", "product_extract"])
+queue_logging(summary_logger)
+
 # Configuration
-BATCH_SIZE = 50
-DELAY = 0.1
+MONGO_URI = "mongodb://localhost:27017/"
+MONGO_DB = "countly"  # 7.crawler-benchmark.py points the crawler at its own database
+BATCH_SIZE = 50  # Bulk write size
+FLUSH_INTERVAL = 5  # Seconds before a partial bulk write is flushed anyway
 TIMEOUT = 10
 MAX_WORKERS = 16
+QUEUE_SIZE = MAX_WORKERS * 4  # Bound on docs waiting to be fetched / written
+# Crawl engine: "threads" (cursor -> MAX_WORKERS fetch threads -> writer) or "asyncio"
+# (one aiohttp session keeping up to ASYNC_MAX_CONCURRENCY requests in flight,
+# at most ASYNC_PER_HOST_LIMIT of them to the same host)
+ENGINE = "asyncio"
+ASYNC_MAX_CONCURRENCY = 256
+ASYNC_PER_HOST_LIMIT = 64
+# Adaptive per-domain concurrency (AIMD): each glamira domain starts at
+# DOMAIN_INITIAL_CONCURRENCY requests in flight, gains about one slot per healthy
+# round while its latency EWMA stays under DOMAIN_LATENCY_TARGET seconds, and is
+# halved on 429/503, 5xx and timeouts (at most once per round trip).
+# The cap is MAX_WORKERS (threads) or ASYNC_PER_HOST_LIMIT (asyncio). Current
+# limits go to the summary log every DOMAIN_LOG_INTERVAL seconds
+ADAPTIVE_CONCURRENCY = True
+DOMAIN_INITIAL_CONCURRENCY = 4
+DOMAIN_LATENCY_TARGET = 3.0
+DOMAIN_LOG_INTERVAL = 30
+# Parser stage: fetchers hand raw bytes to a pool of PARSE_WORKERS processes so HTML
+# parsing does not compete with network I/O for the GIL (0 = parse in the fetcher)
+PARSE_WORKERS = os.cpu_count() or 1
+# Raw page archive: keep every fetched body (gzip, content-addressed) and its
+# headers so 4.2.re-extract-archive.py can rerun the selectors without refetching
+ARCHIVE_PAGES = False
+ARCHIVE_DIR = "page_archive"
+# URL dedup: store a canonical_url (no variant/tracking parameters, normalized host,
+# known redirects followed) on pending docs and fetch each canonical page once,
+# fanning its result out to every product_id on it. Redirects seen while crawling
+# are saved to REDIRECTS_COLLECTION and applied on the next run
+CANONICALIZE_URLS = True
+REDIRECTS_COLLECTION = "url_redirects"
+# Retries: a failed fetch frees its worker at once and the doc gets next_attempt_at,
+# RETRY_BASE_DELAY * 2^(attempt-1) seconds away (jittered, capped at RETRY_MAX_DELAY,
+# at least the server's Retry-After), for up to MAX_ATTEMPTS attempts. Network
+# errors, 429 and 5xx stay pending and are re-fed in the same run when due within
+# RETRY_HORIZON seconds; other failures are marked failed and retried by a later run
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 3600
+RETRY_HORIZON = 60
+# Work queue: any number of crawler processes, on any machine, can run against the
+# same product_names. Each claims CLAIM_BATCH due docs at a time (status in_progress,
+# worker_id, lease_expires_at) and only it may write them back; docs whose lease
+# ran out LEASE_SECONDS after the claim go back to the other crawlers
+CLAIM_BATCH = 200
+LEASE_SECONDS = 600
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+# CPU, memory and network counters are logged from a background thread
+METRICS_INTERVAL = 30
+# Latency histograms per stage (dns, connect, ttfb, download, fetch = ttfb +
+# download, parse, match, mongo_write, mongo_claim) and requests by domain and HTTP status, served in
+# Prometheus format on http://127.0.0.1:METRICS_PORT/metrics during a run
+# (0 = off) and saved as JSON to METRICS_SNAPSHOT at the end
+METRICS_PORT = 9108
+METRICS_SNAPSHOT = f"logs/crawl_metrics_{timestamp}.json"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Accept-Language": "en-US,en;q=0.9",
 }
 
+page_archive = PageArchive(ARCHIVE_DIR) if ARCHIVE_PAGES else None
+metrics = CrawlMetrics()
+
 # MongoDB connection pool
 mongo_client = None
 mongo_lock = threading.Lock()
@@ -73,150 +168,922 @@ def get_mongo_collection():
     global mongo_client
     with mongo_lock:
         if mongo_client is None:
-            mongo_client = MongoClient("mongodb://localhost:27017/", maxPoolSize=50)
-        return mongo_client["countly"]["product_names"]
+            mongo_client = MongoClient(MONGO_URI, maxPoolSize=50)
+        return mongo_client[MONGO_DB]["product_names"]
 
 
-def log_system_metrics():
-    """Log CPU and memory usage"""
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
-    logger.info(
-        f"System Metrics: CPU Usage: {cpu_percent}% | Memory Usage: {memory.percent}% ({memory.used/1024**3:.2f} GB)"
-    )
+def retryable_status(status):
+    """Statuses worth another attempt soon: timeouts, throttling and server errors"""
+    return status in (408, 425, 429) or status >= 500
 
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_fixed(2),
-    retry=retry_if_exception_type(requests.exceptions.RequestException),
-    after=lambda retry_state: logger.debug(
-        f"Retry {retry_state.attempt_number} for {retry_state.args[1]}"
-    ),
-)
-def scrape_product_name(url, product_id):
-    """Scrape product name for a single URL with retry logic"""
+def exception_info(e, start):
+    """fetch_info for a request that raised e after starting at start (perf_counter).
+    reason uses the categories of 4.1.failed-handle.py"""
+    if isinstance(e, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+        reason = "Timeout"
+    elif isinstance(
+        e, (requests.exceptions.ConnectionError, aiohttp.ClientConnectionError)
+    ):
+        reason = "Connection error"
+    elif isinstance(e, (requests.exceptions.RequestException, aiohttp.ClientError)):
+        reason = "Request error"
+    else:
+        reason = "Unexpected error"
+    return {
+        "reason": reason,
+        "exception": type(e).__name__,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def fetch_page(url, product_id, validators=None, gate=None):
+    """Download a page for the parser stage.
+
+    validators are the saved ETag / Last-Modified of the page; gate, when given,
+    admits the request under its domain's current concurrency limit. Returns
+    (page, fetch_info): page is (body, encoding, source), or None after a 304
+    or a failed request; fetch_info carries the HTTP status, stage timings, the
+    304 flag and new validators, or whether a failure is retryable and the
+    server's Retry-After; a request that raised also carries its failure reason,
+    exception class and elapsed seconds.
+    """
+    start = time.perf_counter()
     try:
-        logger.debug(f"Scraping: {product_id} - {url}")
-        start_time = time.time()
+        url_logger.debug(f"Scraping: {product_id} - {url}")
+
+        slot = gate.slot(url_domain(url)) if gate else nullcontext(RequestSlot())
+        with slot as request:
+            start = time.perf_counter()
+            # Streamed so time to first byte and body download are timed apart
+            response = get_session(HEADERS).get(
+                url,
+                headers=conditional_headers(validators or {}),
+                timeout=TIMEOUT,
+                stream=True,
+            )
+            headers_at = time.perf_counter()
+            body = response.content
+            done_at = time.perf_counter()
+            timings = {
+                "fetch": done_at - start,
+                "ttfb": headers_at - start,
+                "download": done_at - headers_at,
+            }
+            request.status = response.status_code
+            request.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        fetch_info = {"status": response.status_code, "timings": timings}
+        if response.status_code == 304:
+            url_logger.info(f"Not modified: {product_id} - {url}")
+            return None, {**fetch_info, "not_modified": True}
+        if page_archive is not None:
+            page_archive.save(
+                url,
+                product_id,
+                response.status_code,
+                response.headers,
+                body,
+            )
+        if response.status_code >= 400:
+            logger.warning(
+                f"Request failed for {product_id}: {url} - HTTP {response.status_code}"
+            )
+            return None, {
+                **fetch_info,
+                "retryable": retryable_status(response.status_code),
+                "retry_after": request.retry_after,
+            }
 
-        response = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-        response.raise_for_status()
+        page = (
+            body,
+            declared_charset(response.headers),
+            f"HTTP {response.status_code}",
+        )
+        return page, {
+            **fetch_info,
+            "not_modified": False,
+            "final_url": response.url,
+            **response_validators(response.headers),
+        }
 
-        parser_counts = {"lxml": 0, "html5lib": 0, "html.parser": 0}
-        parser_used = None
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Request failed for {product_id}: {url} - {str(e)}")
+        return None, {**exception_info(e, start), "retryable": True}
+    except Exception as e:
+        logger.error(f"Unexpected error for {product_id}: {url} - {str(e)}")
+        return None, exception_info(e, start)
 
-        # Try parsers in order of preference
-        for parser in ["lxml", "html5lib", "html.parser"]:
-            try:
-                soup = BeautifulSoup(response.text, parser)
-                parser_used = parser
-                parser_counts[parser] += 1
-                break
-            except ValueError as e:
-                logger.warning(
-                    f"{parser} parser unavailable for {product_id}: {str(e)}, trying next parser"
-                )
-                continue
 
-        if not parser_used:
-            logger.error(f"No parsers available for {product_id}: {url}")
-            return None, False, parser_counts
+def unparsed_result(fetch_info):
+    """Scrape result for a fetch that left nothing to parse (304 or failure)"""
+    return None, bool(fetch_info.get("not_modified")), dict(NO_PARSER), fetch_info
+
 
-        logger.debug(f"Using {parser_used} parser for {product_id}")
+def parsed_result(parsed, fetch_info):
+    """Scrape result from timed_extract_page output, parse timings merged into
+    fetch_info["timings"] and the selectors tried on a miss"""
+    product_name, success, parser_counts, timings = parsed
+    fetch_info = {**fetch_info, "timings": {**fetch_info.get("timings", {}), **timings}}
+    if not success:
+        fetch_info["selectors_tried"] = SELECTOR_NAMES
+    return product_name, success, parser_counts, fetch_info
 
-        selectors = [
-            {"name": "h1", "class": "product-name"},
-            {"class": "product-title"},
-            {"class": "product_title"},
-            {"name": "h1"},
+
+def failure_details(fetch_info):
+    """Why a scrape failed, saved on its docs as failure for 4.1.failed-handle.py"""
+    status = fetch_info.get("status")
+    if fetch_info.get("reason"):
+        reason = fetch_info["reason"]
+    elif status is not None and status >= 400:
+        reason = f"HTTP {status}"
+    elif "selectors_tried" in fetch_info:
+        reason = "No selectors matched"
+    elif fetch_info.get("not_modified"):
+        reason = "Not modified, no saved name"
+    else:
+        reason = "Unexpected error"
+    return {
+        "reason": reason,
+        "http_status": status,
+        "exception": fetch_info.get("exception"),
+        "elapsed": fetch_info.get(
+            "elapsed", fetch_info.get("timings", {}).get("fetch")
+        ),
+        "selectors_tried": fetch_info.get("selectors_tried", []),
+        "failed_at": datetime.now(timezone.utc),
+    }
+
+
+def record_metrics(job, fetch_info):
+    """Count the job's request and record its stage timings"""
+    fetch_info = fetch_info or {}
+    metrics.count_request(url_domain(job["current_url"]), fetch_info.get("status"))
+    metrics.observe_all(fetch_info.get("timings", {}))
+
+
+def scrape_product_name(url, product_id, validators=None):
+    """Fetch and parse a single URL in the calling thread.
+
+    Returns (product_name, success, parser_counts, fetch_info).
+    """
+    page, fetch_info = fetch_page(url, product_id, validators)
+    if page is None:
+        return unparsed_result(fetch_info)
+    return parsed_result(timed_extract_page(*page, product_id, url), fetch_info)
+
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds before the next try after failed attempt number attempt (1-based):
+    exponential backoff with jitter, never shorter than the server's Retry-After"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return max(delay, retry_after or 0)
+
+
+def release_lease(update):
+    """Add the $unset that hands a doc's lease back to an update document"""
+    update.setdefault("$unset", {}).update(
+        {"worker_id": "", "claim_id": "", "lease_expires_at": ""}
+    )
+    return update
+
+
+def build_update_operation(
+    doc, product_name, success, fetch_info=None, next_attempt_at=None, in_run=False
+):
+    """UpdateOne recording a scrape result, shared by both crawl engines.
+
+    A failure with attempts left is scheduled for next_attempt_at: it stays
+    pending when retryable, otherwise it is marked failed until then. in_run
+    retries keep their lease until next_attempt_at + LEASE_SECONDS. Only the claim
+    that leased the doc can write it, so a worker whose lease expired and was
+    reclaimed elsewhere does not overwrite the newer result. Failures save
+    failure_details on the doc and a success clears them.
+    """
+    fetch_info = fetch_info or {}
+    retry_count = doc.get("retry_count", 0) + 1
+    doc_filter = {"_id": doc["_id"], "claim_id": doc.get("claim_id")}
+    if fetch_info.get("not_modified"):
+        # 304: the page is unchanged, keep the name extracted last time
+        product_name = doc.get("product_name")
+        success = bool(product_name)
+    if success:
+        url_logger.info(
+            f"Updated {doc['product_id']} to status: processed (Retries: {retry_count})"
+        )
+        validators = {
+            key: fetch_info[key]
+            for key in ("etag", "last_modified")
+            if key in fetch_info
+        }
+        return UpdateOne(
+            doc_filter,
+            release_lease(
+                {
+                    "$set": {
+                        "product_name": product_name,
+                        "status": "processed",
+                        "retry_count": retry_count,
+                        **validators,
+                    },
+                    "$unset": {"next_attempt_at": "", "failure": ""},
+                }
+            ),
+        )
+    failure = failure_details(fetch_info)
+    if next_attempt_at is not None and retry_count < MAX_ATTEMPTS:
+        if in_run:
+            status = "in_progress"
+        else:
+            status = "pending" if fetch_info.get("retryable") else "failed"
+        url_logger.info(
+            f"Updated {doc['product_id']} to status: {status} (Retries: {retry_count}, "
+            f"next attempt at {next_attempt_at:%Y-%m-%d %H:%M:%S})"
+        )
+        update = {
+            "$set": {
+                "status": status,
+                "retry_count": retry_count,
+                "next_attempt_at": next_attempt_at,
+                "failure": failure,
+            }
+        }
+        if in_run:
+            lease_expires_at = next_attempt_at + timedelta(seconds=LEASE_SECONDS)
+            update["$set"]["lease_expires_at"] = lease_expires_at
+        else:
+            release_lease(update)
+        return UpdateOne(doc_filter, update)
+    url_logger.info(
+        f"Updated {doc['product_id']} to status: failed (Retries: {retry_count})"
+    )
+    return UpdateOne(
+        doc_filter,
+        release_lease(
+            {
+                "$set": {
+                    "status": "failed",
+                    "retry_count": retry_count,
+                    "failure": failure,
+                },
+                "$unset": {"next_attempt_at": ""},
+            }
+        ),
+    )
+
+
+def job_operations(job, product_name, success, fetch_info=None, scheduler=None):
+    """Fan a page result out to the job's docs: (operations, counts).
+
+    counts splits the job's docs into "succeeded", "failed", "pending" (retryable
+    failure with attempts left, for a later run) and "requeued" (the same, handed
+    to scheduler, still leased, when due within its horizon). Only requeued docs
+    are not yet final: they come back as another job.
+    """
+    fetch_info = fetch_info or {}
+    if fetch_info.get("not_modified"):
+        success = bool(job["product_name"])
+    next_attempt_at = None
+    in_run = False
+    retry_members = []
+    if not success:
+        attempt = 1 + max(member.get("retry_count", 0) for member in job["members"])
+        delay = retry_delay(attempt, fetch_info.get("retry_after"))
+        next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        retry_members = [
+            {**member, "retry_count": member.get("retry_count", 0) + 1}
+            for member in job["members"]
+            if member.get("retry_count", 0) + 1 < MAX_ATTEMPTS
         ]
+        if retry_members and fetch_info.get("retryable") and scheduler is not None:
+            in_run = scheduler.schedule(
+                {**job, "members": retry_members}, time.time() + delay
+            )
+    operations = [
+        build_update_operation(
+            {**member, "product_name": job["product_name"]},
+            product_name,
+            success,
+            fetch_info,
+            next_attempt_at,
+            in_run,
+        )
+        for member in job["members"]
+    ]
+    counts = {"succeeded": 0, "failed": 0, "pending": 0, "requeued": 0}
+    if success:
+        counts["succeeded"] = len(job["members"])
+        return operations, counts
+    if fetch_info.get("retryable"):
+        counts["requeued" if in_run else "pending"] = len(retry_members)
+    counts["failed"] = len(job["members"]) - counts["requeued"] - counts["pending"]
+    return operations, counts
+
+
+def redirect_operation(job, fetch_info):
+    """url_redirects upsert when the job's page redirected elsewhere, else None"""
+    final_url = (fetch_info or {}).get("final_url")
+    if not final_url:
+        return None
+    target = canonical_url(final_url)
+    if target == job["current_url"]:
+        return None
+    url_logger.info(f"Redirect: {job['current_url']} -> {target}")
+    return redirect_upsert(job["current_url"], target)
+
+
+def page_job(url, members):
+    """One fetch of url on behalf of the product_names docs in members.
+
+    Validators come from a member that already has a name, so a 304 has a name
+    to fan out.
+    """
+    known = next(
+        (
+            member
+            for member in members
+            if member.get("product_name")
+            and (member.get("etag") or member.get("last_modified"))
+        ),
+        {},
+    )
+    return {
+        "current_url": url,
+        "product_id": members[0]["product_id"],
+        "product_name": known.get("product_name"),
+        "etag": known.get("etag"),
+        "last_modified": known.get("last_modified"),
+        "members": members,
+    }
+
+
+def canonicalize_pending(collection, query, redirects):
+    """Store canonical_url on pending docs where it is missing or out of date"""
+    operations = []
+    updated = 0
+    for doc in collection.find(query, {"current_url": 1, "canonical_url": 1}):
+        canonical = canonical_url(doc["current_url"], redirects)
+        if doc.get("canonical_url") == canonical:
+            continue
+        operations.append(
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"canonical_url": canonical}})
+        )
+        if len(operations) >= 1000:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+def claimable_query(now, due_by=None):
+    """Docs a crawler may claim: due for an attempt by due_by (default now) with
+    attempts left, or leased by a worker whose lease has expired (it crashed or
+    stalled). Docs without a usable current_url (missing, null, not a string or
+    blank) are never claimed: there is nothing to fetch or canonicalize"""
+    return {
+        "current_url": {"$type": "string", "$regex": r"\S"},
+        "$and": [
+            {
+                "$or": [
+                    {"retry_count": {"$exists": False}},
+                    {"retry_count": {"$lt": MAX_ATTEMPTS}},
+                ]
+            },
+            {
+                "$or": [
+                    # Failed docs only come back with a due next_attempt_at (scheduled
+                    # failures, or ones from before the retry schedule existed)
+                    {
+                        "status": {"$in": ["pending", "failed"]},
+                        "$or": [
+                            {"next_attempt_at": {"$exists": False}},
+                            {"next_attempt_at": {"$lte": due_by or now}},
+                        ],
+                    },
+                    {"status": "in_progress", "lease_expires_at": {"$lt": now}},
+                ]
+            },
+        ],
+    }
+
 
-        for selector in selectors:
-            element = (
-                soup.find(**selector)
-                if isinstance(selector, dict)
-                else soup.find(selector)
+def ensure_queue_indexes(collection):
+    """Indexes the claim queries rely on (no-ops once they exist)"""
+    collection.create_index([("status", 1), ("next_attempt_at", 1)])
+    collection.create_index("claim_id", sparse=True)
+    collection.create_index("canonical_url")
+
+
+def count_pages(collection, query):
+    """Distinct canonical pages among the docs matching query"""
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": "$canonical_url"}},
+        {"$count": "pages"},
+    ]
+    counted = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return counted[0]["pages"] if counted else 0
+
+
+def claim_jobs(collection, worker_id, redirects=None):
+    """Claim due docs CLAIM_BATCH at a time and yield them as page jobs until none
+    are left. Each claim is one update_many on the claimable filter, so concurrent
+    crawlers never lease the same doc; with CANONICALIZE_URLS a claim takes every
+    claimable doc of the canonical URLs it picks. Docs scheduled after the first
+    claim are left to the next run (in-run retries come from the RetryScheduler).
+    """
+    due_by = datetime.now(timezone.utc)
+    while True:
+        now = datetime.now(timezone.utc)
+        claimable = claimable_query(now, due_by)
+        candidates = list(
+            collection.find(claimable, {"canonical_url": 1}).limit(CLAIM_BATCH)
+        )
+        if not candidates:
+            return
+        ids = [doc["_id"] for doc in candidates]
+        urls = {doc.get("canonical_url") for doc in candidates} - {None}
+        if CANONICALIZE_URLS and urls:
+            target = {
+                "$or": [{"_id": {"$in": ids}}, {"canonical_url": {"$in": list(urls)}}]
+            }
+        else:
+            target = {"_id": {"$in": ids}}
+        claim_id = uuid.uuid4().hex
+        claim_start = time.perf_counter()
+        collection.update_many(
+            {"$and": [claimable, target]},
+            {
+                "$set": {
+                    "status": "in_progress",
+                    "worker_id": worker_id,
+                    "claim_id": claim_id,
+                    "lease_expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                }
+            },
+        )
+        docs = list(collection.find({"claim_id": claim_id}))
+        metrics.observe("mongo_claim", time.perf_counter() - claim_start)
+        logger.debug(f"Claimed {len(docs)} documents ({claim_id})")
+
+        if not CANONICALIZE_URLS:
+            for doc in docs:
+                yield page_job(doc["current_url"], [doc])
+            continue
+        pages = {}
+        for doc in docs:
+            url = doc.get("canonical_url") or canonical_url(
+                doc["current_url"], redirects
             )
-            if element:
-                product_name = element.get_text(strip=True)
-                if product_name:
-                    logger.info(
-                        f"Found name for {product_id} using {selector}: {product_name} (HTTP {response.status_code}, {parser_used})"
+            pages.setdefault(url, []).append(doc)
+        for url, members in pages.items():
+            yield page_job(url, members)
+
+
+def domain_limiter(maximum):
+    """AIMD per-domain limits from the DOMAIN_* settings, capped at maximum"""
+    return AimdLimiter(
+        DOMAIN_INITIAL_CONCURRENCY,
+        1,
+        maximum,
+        latency_target=DOMAIN_LATENCY_TARGET,
+        adaptive=ADAPTIVE_CONCURRENCY,
+    )
+
+
+def crawl_threaded(collection, cursor, total_to_process, parse_pool=None):
+    """Thread engine: a cursor producer, fetch workers and a batched writer linked by
+    bounded queues, so no worker waits for the slowest URL of a batch.
+
+    cursor yields page jobs (see page_job) and total_to_process counts them. With
+    a parse_pool, fetch workers only download and submit the bytes to it; the
+    writer collects the parsed results.
+    """
+    # Every fetch thread keeps its own keep-alive session, so MAX_WORKERS threads
+    # hold at most MAX_WORKERS connections per host
+    install_dns_cache()
+    set_timing_observer(metrics.observe)
+    gate = DomainGate(
+        domain_limiter(MAX_WORKERS), timeout_errors=(requests.exceptions.Timeout,)
+    )
+    scheduler = RetryScheduler(RETRY_HORIZON)
+    fetch_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    result_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    producer_error = []
+
+    def produce():
+        try:
+            for batch in scheduler.batches(cursor, BATCH_SIZE):
+                for job in batch:
+                    fetch_queue.put(job)
+        except Exception as e:
+            producer_error.append(e)
+        finally:
+            # One end marker per worker
+            for _ in range(MAX_WORKERS):
+                fetch_queue.put(None)
+
+    def fetch():
+        while True:
+            doc = fetch_queue.get()
+            if doc is None:
+                result_queue.put(None)
+                return
+            try:
+                page, fetch_info = fetch_page(
+                    doc["current_url"], doc["product_id"], doc, gate
+                )
+                if page is None:
+                    result = unparsed_result(fetch_info)
+                elif parse_pool is None:
+                    result = parsed_result(
+                        timed_extract_page(
+                            *page, doc["product_id"], doc["current_url"]
+                        ),
+                        fetch_info,
                     )
-                    return product_name, True, parser_counts
-        logger.warning(
-            f"No product name found for {product_id}: {url} (HTTP {response.status_code}, {parser_used})"
+                else:
+                    future = parse_pool.submit(
+                        timed_extract_page, *page, doc["product_id"], doc["current_url"]
+                    )
+                    result = (future, fetch_info)
+            except Exception as e:
+                logger.error(f"Error processing {doc['product_id']}: {str(e)}")
+                result = unparsed_result(
+                    {"reason": "Unexpected error", "exception": type(e).__name__}
+                )
+            result_queue.put((doc, result))
+
+    threads = [threading.Thread(target=produce, daemon=True)] + [
+        threading.Thread(target=fetch, daemon=True) for _ in range(MAX_WORKERS)
+    ]
+    for thread in threads:
+        thread.start()
+
+    operations = []
+    redirect_operations = []
+    redirects = collection.database[REDIRECTS_COLLECTION]
+    processed = 0
+    succeeded = 0
+    failed = 0
+    pending = 0
+    retried = 0
+    total_parser_counts = {"lxml": 0, "html5lib": 0, "html.parser": 0}
+    last_flush = time.time()
+    last_domain_log = time.time()
+
+    def flush():
+        start = time.perf_counter()
+        result = collection.bulk_write(operations, ordered=False)
+        metrics.observe("mongo_write", time.perf_counter() - start)
+        logger.debug(f"Updated {result.modified_count} documents in batch")
+        summary_logger.info(
+            f"Batch update: {len(operations)} operations, {result.modified_count} modified"
         )
-        return None, False, parser_counts
+        operations.clear()
+        if redirect_operations:
+            redirects.bulk_write(redirect_operations, ordered=False)
+            redirect_operations.clear()
 
-    except requests.exceptions.RequestException as e:
+    # The calling thread is the writer: it flushes by size or after FLUSH_INTERVAL
+    with tqdm(total=total_to_process, desc="Processing documents", unit="doc") as pbar:
+        running = MAX_WORKERS
+        while running:
+            try:
+                item = result_queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                running -= 1
+            elif item:
+                job, result = item
+                documents = len(job["members"])
+                pbar.update(1)
+                if isinstance(result[0], Future):
+                    try:
+                        result = parsed_result(result[0].result(), result[1])
+                    except Exception as e:
+                        logger.error(f"Error parsing {job['product_id']}: {str(e)}")
+                        result = unparsed_result(
+                            {
+                                "reason": "Unexpected error",
+                                "exception": type(e).__name__,
+                            }
+                        )
+                product_name, success, doc_parser_counts, fetch_info = result
+                record_metrics(job, fetch_info)
+                for parser, count in doc_parser_counts.items():
+                    total_parser_counts[parser] += count
+                # Unexpected errors go through here too, so their docs are released
+                # and scheduled like any other failure
+                job_ops, counts = job_operations(
+                    job, product_name, success, fetch_info, scheduler
+                )
+                operations.extend(job_ops)
+                redirect = redirect_operation(job, fetch_info)
+                if redirect is not None:
+                    redirect_operations.append(redirect)
+                # Requeued docs are counted as processed when their retry settles
+                processed += documents - counts["requeued"]
+                succeeded += counts["succeeded"]
+                failed += counts["failed"]
+                pending += counts["pending"]
+                retried += counts["requeued"]
+                if counts["requeued"]:
+                    pbar.total += 1
+                scheduler.finished()
+
+            if operations and (
+                len(operations) >= BATCH_SIZE
+                or time.time() - last_flush >= FLUSH_INTERVAL
+                or not running
+            ):
+                flush()
+                last_flush = time.time()
+
+            if time.time() - last_domain_log >= DOMAIN_LOG_INTERVAL:
+                summary_logger.info(f"Domain limits: {gate.describe()}")
+                last_domain_log = time.time()
+
+    summary_logger.info(f"Final domain limits: {gate.describe()}")
+    if producer_error:
+        raise producer_error[0]
+    return processed, succeeded, failed, pending, retried, total_parser_counts
+
+
+async def fetch_page_async(session, url, product_id, validators=None, gate=None):
+    """asyncio counterpart of fetch_page, same return values"""
+    start = time.perf_counter()
+    try:
+        url_logger.debug(f"Scraping: {product_id} - {url}")
+        slot = gate.slot(url_domain(url)) if gate else nullcontext(RequestSlot())
+        # The body download counts towards the domain's latency too
+        async with slot as request:
+            start = time.perf_counter()
+            async with session.get(
+                url, headers=conditional_headers(validators or {})
+            ) as response:
+                headers_at = time.perf_counter()
+                body = await response.read()
+                done_at = time.perf_counter()
+                timings = {
+                    "fetch": done_at - start,
+                    "ttfb": headers_at - start,
+                    "download": done_at - headers_at,
+                }
+                request.status = response.status
+                request.retry_after = parse_retry_after(
+                    response.headers.get("Retry-After")
+                )
+        fetch_info = {"status": response.status, "timings": timings}
+        if response.status == 304:
+            url_logger.info(f"Not modified: {product_id} - {url}")
+            return None, {**fetch_info, "not_modified": True}
+        if page_archive is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                page_archive.save,
+                url,
+                product_id,
+                response.status,
+                response.headers,
+                body,
+            )
+        if response.status >= 400:
+            logger.warning(
+                f"Request failed for {product_id}: {url} - HTTP {response.status}"
+            )
+            return None, {
+                **fetch_info,
+                "retryable": retryable_status(response.status),
+                "retry_after": request.retry_after,
+            }
+        page = (body, declared_charset(response.headers), f"HTTP {response.status}")
+        return page, {
+            **fetch_info,
+            "not_modified": False,
+            "final_url": str(response.url),
+            **response_validators(response.headers),
+        }
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.warning(f"Request failed for {product_id}: {url} - {str(e)}")
-        return None, False, {"lxml": 0, "html5lib": 0, "html.parser": 0}
+        return None, {**exception_info(e, start), "retryable": True}
     except Exception as e:
         logger.error(f"Unexpected error for {product_id}: {url} - {str(e)}")
-        return None, False, {"lxml": 0, "html5lib": 0, "html.parser": 0}
+        return None, exception_info(e, start)
+
+
+async def scrape_product_name_async(
+    session, url, product_id, validators=None, parse_pool=None, gate=None
+):
+    """asyncio counterpart of scrape_product_name, same return values"""
+    page, fetch_info = await fetch_page_async(
+        session, url, product_id, validators, gate
+    )
+    if page is None:
+        return unparsed_result(fetch_info)
+    # Parsing is CPU work, keep it off the event loop (parse_pool None = threads)
+    parsed = await asyncio.get_running_loop().run_in_executor(
+        parse_pool, timed_extract_page, *page, product_id, url
+    )
+    return parsed_result(parsed, fetch_info)
+
+
+def timing_trace_config():
+    """aiohttp tracing that records DNS lookups (cache misses) and new connections"""
+
+    async def dns_start(session, context, params):
+        context.dns_start = time.perf_counter()
+
+    async def dns_end(session, context, params):
+        metrics.observe("dns", time.perf_counter() - context.dns_start)
+
+    async def connect_start(session, context, params):
+        context.connect_start = time.perf_counter()
 
+    async def connect_end(session, context, params):
+        metrics.observe("connect", time.perf_counter() - context.connect_start)
 
-def process_batch(docs):
-    """Process a batch of documents in parallel"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(dns_start)
+    trace_config.on_dns_resolvehost_end.append(dns_end)
+    trace_config.on_connection_create_start.append(connect_start)
+    trace_config.on_connection_create_end.append(connect_end)
+    return trace_config
+
+
+async def crawl_async(collection, cursor, total_to_process, parse_pool=None):
+    """asyncio engine: keep up to ASYNC_MAX_CONCURRENCY scrapes in flight in one session"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    scheduler = RetryScheduler(RETRY_HORIZON)
+    gate = AsyncDomainGate(
+        domain_limiter(ASYNC_PER_HOST_LIMIT), timeout_errors=(asyncio.TimeoutError,)
+    )
+    last_domain_log = time.time()
     operations = []
+    redirect_operations = []
+    redirects = collection.database[REDIRECTS_COLLECTION]
+    processed = 0
     succeeded = 0
     failed = 0
-    parser_counts = {"lxml": 0, "html5lib": 0, "html.parser": 0}
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_doc = {
-            executor.submit(
-                scrape_product_name, doc["current_url"], doc["product_id"]
-            ): doc
-            for doc in docs
-        }
+    pending = 0
+    retried = 0
+    total_parser_counts = {"lxml": 0, "html5lib": 0, "html.parser": 0}
+    last_flush = time.time()
 
-        for future in as_completed(future_to_doc):
-            doc = future_to_doc[future]
-            try:
-                product_name, success, doc_parser_counts = future.result()
-                for parser, count in doc_parser_counts.items():
-                    parser_counts[parser] += count
+    async def flush():
+        nonlocal last_flush
+        batch = operations[:]
+        operations.clear()
+        last_flush = time.time()
 
-                retry_count = doc.get("retry_count", 0) + 1
-                if success:
-                    operations.append(
-                        UpdateOne(
-                            {"_id": doc["_id"]},
-                            {
-                                "$set": {
-                                    "product_name": product_name,
-                                    "status": "processed",
-                                    "retry_count": retry_count,
-                                }
-                            },
-                        )
-                    )
-                    logger.info(
-                        f"Updated {doc['product_id']} to status: processed (Retries: {retry_count})"
-                    )
-                    succeeded += 1
-                else:
-                    operations.append(
-                        UpdateOne(
-                            {"_id": doc["_id"]},
-                            {"$set": {"status": "failed", "retry_count": retry_count}},
-                        )
-                    )
-                    logger.info(
-                        f"Updated {doc['product_id']} to status: failed (Retries: {retry_count})"
-                    )
-                    failed += 1
+        def write():
+            start = time.perf_counter()
+            result = collection.bulk_write(batch, ordered=False)
+            metrics.observe("mongo_write", time.perf_counter() - start)
+            return result
+
+        # pymongo is blocking, run the bulk write in the default executor
+        result = await loop.run_in_executor(None, write)
+        logger.debug(f"Updated {result.modified_count} documents in batch")
+        summary_logger.info(
+            f"Batch update: {len(batch)} operations, {result.modified_count} modified"
+        )
+        if redirect_operations:
+            redirect_batch = redirect_operations[:]
+            redirect_operations.clear()
+            await loop.run_in_executor(
+                None, lambda: redirects.bulk_write(redirect_batch, ordered=False)
+            )
+
+    async def scrape(job, session, pbar):
+        nonlocal processed, succeeded, failed, pending, retried, last_domain_log
+        documents = len(job["members"])
+        try:
+            try:
+                result = await scrape_product_name_async(
+                    session,
+                    job["current_url"],
+                    job["product_id"],
+                    job,
+                    parse_pool,
+                    gate,
+                )
             except Exception as e:
-                logger.error(f"Error processing {doc['product_id']}: {str(e)}")
-                failed += 1
+                logger.error(f"Error processing {job['product_id']}: {str(e)}")
+                # Recorded like any other failure, so the docs are released and
+                # scheduled instead of waiting for their lease to expire
+                result = unparsed_result(
+                    {"reason": "Unexpected error", "exception": type(e).__name__}
+                )
+            product_name, success, doc_parser_counts, fetch_info = result
+            record_metrics(job, fetch_info)
+            for parser, count in doc_parser_counts.items():
+                total_parser_counts[parser] += count
+            job_ops, counts = job_operations(
+                job, product_name, success, fetch_info, scheduler
+            )
+            operations.extend(job_ops)
+            redirect = redirect_operation(job, fetch_info)
+            if redirect is not None:
+                redirect_operations.append(redirect)
+            # Requeued docs are counted as processed when their retry settles
+            processed += documents - counts["requeued"]
+            succeeded += counts["succeeded"]
+            failed += counts["failed"]
+            pending += counts["pending"]
+            retried += counts["requeued"]
+            if counts["requeued"]:
+                pbar.total += 1
+            if (
+                len(operations) >= BATCH_SIZE
+                or time.time() - last_flush >= FLUSH_INTERVAL
+            ):
+                await flush()
+            if time.time() - last_domain_log >= DOMAIN_LOG_INTERVAL:
+                summary_logger.info(f"Domain limits: {gate.describe()}")
+                last_domain_log = time.time()
+        except Exception as e:
+            # Building or writing the job's updates failed: its lease runs out instead
+            logger.error(f"Error writing results of {job['product_id']}: {str(e)}")
+        finally:
+            pbar.update(1)
+            semaphore.release()
+            scheduler.finished()
+
+    connector = aiohttp.TCPConnector(
+        limit=ASYNC_MAX_CONCURRENCY,
+        limit_per_host=ASYNC_PER_HOST_LIMIT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    tasks = set()
+    async with aiohttp.ClientSession(
+        headers={**HEADERS, "Accept-Encoding": ACCEPT_ENCODING},
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[timing_trace_config()],
+    ) as session:
+        with tqdm(
+            total=total_to_process, desc="Processing documents", unit="doc"
+        ) as pbar:
+            # Cursor batches (and due retries) are fetched in the executor so
+            # scrapes keep running
+            batches = scheduler.batches(cursor, BATCH_SIZE)
+            while True:
+                jobs = await loop.run_in_executor(None, next, batches, None)
+                if jobs is None:
+                    break
+                for job in jobs:
+                    await semaphore.acquire()
+                    task = asyncio.create_task(scrape(job, session, pbar))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            await asyncio.gather(*tasks)
+            if operations:
+                await flush()
+
+    summary_logger.info(f"Final domain limits: {gate.describe()}")
+
+    return processed, succeeded, failed, pending, retried, total_parser_counts
+
 
-    return operations, succeeded, failed, parser_counts
+def start_parse_pool():
+    """Parser process pool with its workers already running, None when disabled.
+
+    Under the fork start method the pool forks every worker on its first submit;
+    doing that before the fetch threads exist keeps a child from inheriting a lock
+    held by another thread and blocking on it forever.
+    """
+    if not PARSE_WORKERS:
+        return None
+    parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    parse_pool.submit(int).result()
+    return parse_pool
+
+
+def start_metrics_server():
+    """Serve /metrics on METRICS_PORT; the port may be taken by another crawler
+    on this host, then this one only writes its snapshot"""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = serve_metrics(metrics, METRICS_PORT)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on port {METRICS_PORT}: {e}")
+        return None
+    logger.info(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    return server
 
 
 def update_all_product_names():
+    metrics_sampler = SystemMetricsSampler(METRICS_INTERVAL, logger).start()
+    metrics_server = start_metrics_server()
     try:
         logger.info("=== Starting product name update ===")
         summary_logger.info("Starting product name update")
@@ -228,18 +1095,12 @@ def update_all_product_names():
 
         collection = get_mongo_collection()
 
-        total_to_process = collection.count_documents(
-            {
-                "status": "pending",
-                "current_url": {"$exists": True},
-                "$or": [
-                    {"retry_count": {"$exists": False}},
-                    {"retry_count": {"$lt": 3}},
-                ],
-            }
-        )
+        ensure_queue_indexes(collection)
+        claimable = claimable_query(datetime.now(timezone.utc))
+        total_to_process = collection.count_documents(claimable)
         logger.info(
-            f"Found {total_to_process} documents with status 'pending' and retry_count < 3"
+            f"Found {total_to_process} documents due for an attempt "
+            f"(retry_count < {MAX_ATTEMPTS}), crawling as worker {WORKER_ID}"
         )
         summary_logger.info(f"Documents to process: {total_to_process}")
 
@@ -248,104 +1109,73 @@ def update_all_product_names():
             summary_logger.info("No documents to process")
             return
 
-        cursor = collection.find(
-            {
-                "status": "pending",
-                "current_url": {"$exists": True},
-                "$or": [
-                    {"retry_count": {"$exists": False}},
-                    {"retry_count": {"$lt": 3}},
-                ],
-            }
-        ).batch_size(BATCH_SIZE)
-
-        batch = []
-        operations = []
-        processed = 0
-        succeeded = 0
-        failed = 0
-        total_parser_counts = {"lxml": 0, "html5lib": 0, "html.parser": 0}
-
-        # Initialize tqdm progress bar
-        with tqdm(
-            total=total_to_process, desc="Processing documents", unit="doc"
-        ) as pbar:
-            for doc in cursor:
-                batch.append(doc)
-                processed += 1
+        redirects = None
+        total_pages = total_to_process
+        if CANONICALIZE_URLS:
+            redirects = load_redirects(collection.database[REDIRECTS_COLLECTION])
+            updated = canonicalize_pending(collection, claimable, redirects)
+            logger.info(
+                f"Canonicalized {updated} URLs ({len(redirects)} known redirects)"
+            )
+            total_pages = count_pages(collection, claimable)
+            logger.info(f"{total_to_process} documents share {total_pages} pages")
+            summary_logger.info(f"Pages to fetch: {total_pages}")
+        # Other crawlers may claim some of them first, so the totals are upper bounds
+        cursor = claim_jobs(collection, WORKER_ID, redirects)
 
-                if len(batch) >= BATCH_SIZE:
-                    batch_ops, batch_succeeded, batch_failed, batch_parser_counts = (
-                        process_batch(batch)
+        parse_pool = start_parse_pool()
+        try:
+            if ENGINE == "asyncio":
+                processed, succeeded, failed, pending, retried, total_parser_counts = (
+                    asyncio.run(
+                        crawl_async(collection, cursor, total_pages, parse_pool)
                     )
-                    operations.extend(batch_ops)
-                    succeeded += batch_succeeded
-                    failed += batch_failed
-                    for parser, count in batch_parser_counts.items():
-                        total_parser_counts[parser] += count
-
-                    if operations:
-                        result = collection.bulk_write(operations, ordered=False)
-                        logger.debug(
-                            f"Updated {result.modified_count} documents in batch"
-                        )
-                        summary_logger.info(
-                            f"Batch update: {len(operations)} operations, {result.modified_count} modified"
-                        )
-                        operations = []
-
-                    # Update progress bar
-                    pbar.update(len(batch))
-                    log_system_metrics()
-
-                    batch = []
-                    time.sleep(DELAY)
-
-            # Process final batch
-            if batch:
-                batch_ops, batch_succeeded, batch_failed, batch_parser_counts = (
-                    process_batch(batch)
                 )
-                operations.extend(batch_ops)
-                succeeded += batch_succeeded
-                failed += batch_failed
-                for parser, count in batch_parser_counts.items():
-                    total_parser_counts[parser] += count
-
-                if operations:
-                    result = collection.bulk_write(operations, ordered=False)
-                    logger.debug(f"Updated final {result.modified_count} documents")
-                    summary_logger.info(
-                        f"Final batch update: {len(operations)} operations, {result.modified_count} modified"
-                    )
-
-                # Update progress bar for final batch
-                pbar.update(len(batch))
+            else:
+                processed, succeeded, failed, pending, retried, total_parser_counts = (
+                    crawl_threaded(collection, cursor, total_pages, parse_pool)
+                )
+        finally:
+            if parse_pool is not None:
+                parse_pool.shutdown()
 
         duration = time.time() - start_time
         logger.info("=== Update completed ===")
         logger.info(f"Total processed: {processed}")
         logger.info(f"Successfully updated: {succeeded}")
         logger.info(f"Failed to update: {failed}")
+        logger.info(f"Left pending for a later run: {pending}")
+        logger.info(f"Retries within this run: {retried}")
         logger.info(f"Success rate: {succeeded/max(processed,1)*100:.1f}%")
         logger.info(f"Total duration: {duration:.2f} seconds")
         logger.info(f"Average speed: {processed/max(duration,1):.2f} docs/second")
         logger.info(f"Parser usage: {total_parser_counts}")
-        log_system_metrics()
 
         summary_logger.info(
-            f"Update completed: {processed} processed, {succeeded} succeeded, {failed} failed"
+            f"Update completed: {processed} processed, {succeeded} succeeded, "
+            f"{failed} failed, {pending} left pending, {retried} retries within the run"
         )
         summary_logger.info(f"Success rate: {succeeded/max(processed,1)*100:.1f}%")
         summary_logger.info(
             f"Duration: {duration:.2f} seconds, Speed: {processed/max(duration,1):.2f} docs/sec"
         )
         summary_logger.info(f"Parser usage: {total_parser_counts}")
+        for stage, summary in metrics.snapshot()["stages"].items():
+            summary_logger.info(
+                f"Stage {stage}: {summary['count']} samples, "
+                f"p50 {summary['p50'] * 1000:.2f} ms, "
+                f"p99 {summary['p99'] * 1000:.2f} ms"
+            )
 
     except Exception as e:
         logger.critical(f"Fatal error: {str(e)}", exc_info=True)
         summary_logger.critical(f"Fatal error: {str(e)}")
     finally:
+        metrics_sampler.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        metrics.write_snapshot(METRICS_SNAPSHOT)
+        logger.info(f"Metrics snapshot saved to {METRICS_SNAPSHOT}")
         global mongo_client
         with mongo_lock:
             if mongo_client is not None:
@@ -353,6 +1183,8 @@ def update_all_product_names():
                 mongo_client = None
                 logger.info("MongoDB connection closed")
                 summary_logger.info("MongoDB connection closed")
+        if page_archive is not None:
+            page_archive.close()
 
 
 def test_scrape_single_product(url):
@@ -361,7 +1193,9 @@ def test_scrape_single_product(url):
         logger.info(f"Testing URL: {url}")
         summary_logger.info(f"Testing single URL: {url}")
 
-        product_name, success, parser_counts = scrape_product_name(url, "test_product")
+        product_name, success, parser_counts, _ = scrape_product_name(
+            url, "test_product"
+        )
 
         if success:
             logger.info(f"Success! Found product name: {product_name}")
@@ -15,10 +15,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Compact collections (2.1.compact-distinct-ips.py) are reported under the original
+# field names; fields left out of compact documents fall back to their default value
+COMPACT_FIELDS = {"distinct_ips_compact": {"_id": "ip", "cc": "location"}}
+COMPACT_DEFAULTS = {"distinct_ips_compact": {"status": "done"}}
+
 
 def profile_collection(db, collection_name):
     collection = db[collection_name]
     results = []
+    aliases = COMPACT_FIELDS.get(collection_name, {})
+    defaults = COMPACT_DEFAULTS.get(collection_name, {})
 
     total_docs = collection.count_documents({})
     msg = f"Collection '{collection_name}' has {total_docs} documents."
@@ -30,26 +37,45 @@ def profile_collection(db, collection_name):
     sample_cursor = collection.find({}, limit=100)
     for doc in sample_cursor:
         keys.update(doc.keys())
+    keys.update(defaults)
 
     # Profile each key: null/empty counts and distinct values count using aggregation
     for key in keys:
-        count_null = collection.count_documents({key: {"$in": [None, ""]}})
-        pipeline = [
-            {"$match": {key: {"$exists": True, "$ne": None, "$ne": ""}}},
-            {"$group": {"_id": f"${key}"}},
-        ]
+        if key in defaults:
+            count_null = collection.count_documents({key: ""})
+            pipeline = [
+                {"$match": {key: {"$ne": ""}}},
+                {"$group": {"_id": {"$ifNull": [f"${key}", defaults[key]]}}},
+            ]
+        else:
+            count_null = collection.count_documents({key: {"$in": [None, ""]}})
+            pipeline = [
+                {"$match": {key: {"$exists": True, "$ne": None, "$ne": ""}}},
+                {"$group": {"_id": f"${key}"}},
+            ]
         agg_result = list(collection.aggregate(pipeline, allowDiskUse=True))
         distinct_count = len(agg_result)
-        msg = f"Field '{key}' in '{collection_name}': {distinct_count} distinct values, {count_null} null/empty values."
+        msg = f"Field '{aliases.get(key, key)}' in '{collection_name}': {distinct_count} distinct values, {count_null} null/empty values."
         logger.info(msg)
         results.append(msg)
 
     # Additional profiling: view distribution for "status" field if present using aggregation
     if "status" in keys:
-        pipeline = [
-            {"$match": {"status": {"$exists": True, "$ne": None, "$ne": ""}}},
-            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
-        ]
+        if "status" in defaults:
+            pipeline = [
+                {"$match": {"status": {"$ne": ""}}},
+                {
+                    "$group": {
+                        "_id": {"$ifNull": ["$status", defaults["status"]]},
+                        "count": {"$sum": 1},
+                    }
+                },
+            ]
+        else:
+            pipeline = [
+                {"$match": {"status": {"$exists": True, "$ne": None, "$ne": ""}}},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+            ]
         status_results = list(collection.aggregate(pipeline, allowDiskUse=True))
         for res in status_results:
             status = res["_id"]
@@ -67,6 +93,8 @@ if __name__ == "__main__":
         db = client["countly"]
 
         collections_to_profile = ["product_names", "distinct_ips"]
+        if "distinct_ips_compact" in db.list_collection_names():
+            collections_to_profile.append("distinct_ips_compact")
         all_results = []
         for coll in collections_to_profile:
             logger.info(f"Profiling collection: {coll}")
@@ -0,0 +1,418 @@
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import psutil
+from pymongo import MongoClient
+from crawl_metrics import CrawlMetrics
+from page_archive import PageArchive
+
+# Logger
+os.makedirs("logs", exist_ok=True)
+
+timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.FileHandler(f"logs/crawler_benchmark_{timestamp}.log"),
+        logging.StreamHandler(),
+    ],
+)
+logger = logging.getLogger(__name__)
+
+# Configuration
+CRAWLER_SCRIPT = "4.crawl-product-name.py"
+MONGO_URI = "mongodb://localhost:27017/"
+BENCH_DB = "crawler_bench"  # Dropped and reseeded before every run
+ENGINES = ["asyncio", "threads"]
+ROUNDS = 3  # Runs per engine; the summary takes the median
+BENCH_DOCS = 2000
+# Crawler settings changed for the benchmark, on top of its own defaults
+CRAWLER_OVERRIDES = {"METRICS_PORT": 0, "RETRY_BASE_DELAY": 1}
+# Fixture pages: the latest FIXTURE_PAGES responses in the page archive, or synthetic
+# product pages of SYNTHETIC_PAGE_KB when the archive is empty
+ARCHIVE_DIR = "page_archive"
+FIXTURE_PAGES = 500
+SYNTHETIC_PAGE_KB = 150
+# Injected faults. Latency is added before the headers of every response; a URL
+# is either always a 404 (NOT_FOUND_RATE of the URLs) or fails transiently with
+# a 503 on ERROR_RATE of its requests. SLOW_BODY_RATE of the bodies are sent in
+# SLOW_BODY_CHUNKS pieces spread over SLOW_BODY_SECONDS
+LATENCY_MS = 50
+LATENCY_JITTER_MS = 30
+NOT_FOUND_RATE = 0.05
+ERROR_RATE = 0.02
+SLOW_BODY_RATE = 0.02
+SLOW_BODY_SECONDS = 2.0
+SLOW_BODY_CHUNKS = 8
+SEED = 42
+# Results are saved as bench_results/crawler_benchmark_<timestamp>.json. With a
+# BASELINE_FILE (an earlier results file) every engine is compared against it
+# and a drop in docs/sec or a rise in p99 fetch latency beyond
+# REGRESSION_TOLERANCE is logged as a regression
+RESULTS_DIR = "bench_results"
+BASELINE_FILE = None
+REGRESSION_TOLERANCE = 0.10
+
+
+def load_fixture_pages():
+    """Recorded pages (body, content type) from the archive, or synthetic ones"""
+    pages = []
+    if os.path.isdir(ARCHIVE_DIR):
+        archive = PageArchive(ARCHIVE_DIR)
+        for record in archive.latest_records():
+            if record["status"] != 200:
+                continue
+            try:
+                body = archive.read_body(record["sha256"])
+            except OSError:
+                continue
+            headers = {name.lower(): value for name, value in record["headers"].items()}
+            pages.append((body, headers.get("content-type", "text/html")))
+            if len(pages) >= FIXTURE_PAGES:
+                break
+    if pages:
+        logger.info(f"Serving {len(pages)} recorded pages from {ARCHIVE_DIR}")
+        return pages
+
+    filler = (
+        "<div class='product-info'>" + "lorem ipsum dolor sit amet " * 37 + "</div>"
+    )
+    repeat = SYNTHETIC_PAGE_KB * 1024 // len(filler)
+    for i in range(FIXTURE_PAGES):
+        html = (
+            f"<html><head><title>Ring {i} | GLAMIRA</title></head><body>"
+            f"{filler * (repeat // 2)}"
+            f"<h1 class='product-name'>Glamira Ring {i}</h1>"
+            f"{filler * (repeat - repeat // 2)}</body></html>"
+        )
+        pages.append((html.encode("utf-8"), "text/html; charset=utf-8"))
+    logger.info(f"Page archive is empty, serving {len(pages)} synthetic pages")
+    return pages
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves /p/<n>.html from the fixture pages with the configured faults"""
+
+    protocol_version = "HTTP/1.1"
+    pages = []
+    requests_served = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, slow=False, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not slow:
+            self.wfile.write(body)
+            return
+        chunk_size = len(body) // SLOW_BODY_CHUNKS + 1
+        for i in range(0, len(body), chunk_size):
+            time.sleep(SLOW_BODY_SECONDS / SLOW_BODY_CHUNKS)
+            self.wfile.write(body[i : i + chunk_size])
+            self.wfile.flush()
+
+    def do_GET(self):
+        with self.requests_served.get_lock():
+            self.requests_served.value += 1
+        path = self.path.split("?")[0]
+        time.sleep(
+            max(0, LATENCY_MS + random.uniform(-1, 1) * LATENCY_JITTER_MS) / 1000
+        )
+
+        # Missing pages stay missing, so they are picked by URL rather than by request
+        if zlib.crc32(path.encode()) % 10000 < NOT_FOUND_RATE * 10000:
+            self.send_body(404, b"Not Found", "text/plain")
+            return
+        if random.random() < ERROR_RATE:
+            self.send_body(
+                503, b"Service Unavailable", "text/plain", headers={"Retry-After": "1"}
+            )
+            return
+        try:
+            number = int(path.rsplit("/", 1)[-1].split(".")[0])
+        except ValueError:
+            self.send_body(404, b"Not Found", "text/plain")
+            return
+        body, content_type = self.pages[number % len(self.pages)]
+        self.send_body(200, body, content_type, slow=random.random() < SLOW_BODY_RATE)
+
+
+def serve_fixture(pages, requests_served, port_queue):
+    """Fixture server process: reports its port, then serves until terminated"""
+    random.seed(SEED)
+    FixtureHandler.pages = pages
+    FixtureHandler.requests_served = requests_served
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def load_crawler():
+    """Import the crawler script as a module and apply CRAWLER_OVERRIDES"""
+    spec = importlib.util.spec_from_file_location("crawler", CRAWLER_SCRIPT)
+    crawler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(crawler)
+    crawler.MONGO_URI = MONGO_URI
+    crawler.MONGO_DB = BENCH_DB
+    for name, value in CRAWLER_OVERRIDES.items():
+        setattr(crawler, name, value)
+    return crawler
+
+
+def seed_bench_db(client, port):
+    """Drop the benchmark database and insert BENCH_DOCS pending products"""
+    client.drop_database(BENCH_DB)
+    collection = client[BENCH_DB]["product_names"]
+    collection.insert_many(
+        [
+            {
+                "product_id": str(i),
+                "current_url": f"http://127.0.0.1:{port}/p/{i}.html",
+                "product_name": None,
+                "status": "pending",
+            }
+            for i in range(BENCH_DOCS)
+        ]
+    )
+    return collection
+
+
+class ResourceSampler:
+    """CPU time and peak RSS of this process and its children (the parser pool),
+    except the exclude_pids ones"""
+
+    def __init__(self, exclude_pids=(), interval=0.2):
+        self.exclude_pids = set(exclude_pids)
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _cpu_seconds(self):
+        # Children's times are counted once they have exited and been reaped
+        times = self.process.cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def _sample_rss(self):
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            if child.pid in self.exclude_pids:
+                continue
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample_rss()
+
+    def __enter__(self):
+        self.start_cpu = self._cpu_seconds()
+        self._sample_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.cpu_seconds = self._cpu_seconds() - self.start_cpu
+
+
+def run_once(crawler, client, fixture, port, requests_served, engine):
+    """Seed the benchmark database, crawl it with engine and return the results"""
+    collection = seed_bench_db(client, port)
+    crawler.ENGINE = engine
+    crawler.metrics = CrawlMetrics()
+    requests_before = requests_served.value
+
+    with ResourceSampler(exclude_pids=[fixture.pid]) as resources:
+        start = time.perf_counter()
+        crawler.update_all_product_names()
+        duration = time.perf_counter() - start
+
+    statuses = Counter(doc["status"] for doc in collection.find({}, {"status": 1}))
+    finished = statuses["processed"] + statuses["failed"]
+    stages = crawler.metrics.snapshot()["stages"]
+    return {
+        "engine": engine,
+        "docs": BENCH_DOCS,
+        "statuses": dict(statuses),
+        "requests": requests_served.value - requests_before,
+        "duration_s": duration,
+        "docs_per_sec": finished / duration,
+        "latency": {
+            stage: {"p50": summary["p50"], "p99": summary["p99"]}
+            for stage, summary in stages.items()
+        },
+        "cpu_seconds": resources.cpu_seconds,
+        "cpu_percent": resources.cpu_seconds / duration * 100,
+        "peak_rss_mb": resources.peak_rss / 1024**2,
+    }
+
+
+def summarize(runs):
+    """Median of every engine's rounds"""
+    summary = {}
+    for engine in ENGINES:
+        engine_runs = [run for run in runs if run["engine"] == engine]
+        if not engine_runs:
+            continue
+        fetches = [
+            run["latency"]["fetch"] for run in engine_runs if "fetch" in run["latency"]
+        ]
+        summary[engine] = {
+            "docs_per_sec": statistics.median(
+                run["docs_per_sec"] for run in engine_runs
+            ),
+            "fetch_p50": (
+                statistics.median(fetch["p50"] for fetch in fetches)
+                if fetches
+                else None
+            ),
+            "fetch_p99": (
+                statistics.median(fetch["p99"] for fetch in fetches)
+                if fetches
+                else None
+            ),
+            "cpu_percent": statistics.median(run["cpu_percent"] for run in engine_runs),
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in engine_runs),
+        }
+    return summary
+
+
+def compare_with_baseline(summary, baseline_file):
+    """Log each engine's change against the baseline and return the regressions"""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)["summary"]
+    regressions = []
+    for engine, current in summary.items():
+        previous = baseline.get(engine)
+        if previous is None:
+            continue
+        speed_change = current["docs_per_sec"] / previous["docs_per_sec"] - 1
+        logger.info(
+            f"{engine}: {current['docs_per_sec']:.1f} docs/sec vs "
+            f"{previous['docs_per_sec']:.1f} ({speed_change:+.1%})"
+        )
+        if speed_change < -REGRESSION_TOLERANCE:
+            regressions.append(f"{engine} docs/sec {speed_change:+.1%}")
+        if current["fetch_p99"] and previous.get("fetch_p99"):
+            latency_change = current["fetch_p99"] / previous["fetch_p99"] - 1
+            logger.info(
+                f"{engine}: p99 fetch {current['fetch_p99'] * 1000:.0f} ms vs "
+                f"{previous['fetch_p99'] * 1000:.0f} ms ({latency_change:+.1%})"
+            )
+            if latency_change > REGRESSION_TOLERANCE:
+                regressions.append(f"{engine} p99 fetch {latency_change:+.1%}")
+    for regression in regressions:
+        logger.warning(f"Regression: {regression}")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark():
+    logger.info("=== Starting crawler benchmark ===")
+    requests_served = multiprocessing.Value("l", 0)
+    port_queue = multiprocessing.Queue()
+    # Separate process, so serving pages does not count towards the crawler's CPU
+    fixture = multiprocessing.Process(
+        target=serve_fixture,
+        args=(load_fixture_pages(), requests_served, port_queue),
+        daemon=True,
+    )
+    fixture.start()
+    port = port_queue.get(timeout=30)
+    logger.info(f"Fixture server listening on http://127.0.0.1:{port}")
+
+    crawler = load_crawler()
+    client = MongoClient(MONGO_URI)
+    runs = []
+    try:
+        for round_number in range(1, ROUNDS + 1):
+            for engine in ENGINES:
+                result = run_once(
+                    crawler, client, fixture, port, requests_served, engine
+                )
+                runs.append(result)
+                fetch = result["latency"].get("fetch", {})
+                logger.info(
+                    f"Round {round_number} {engine}: "
+                    f"{result['docs_per_sec']:.1f} docs/sec, "
+                    f"{result['requests']} requests, "
+                    f"p50/p99 fetch {fetch.get('p50', 0) * 1000:.0f}/"
+                    f"{fetch.get('p99', 0) * 1000:.0f} ms, "
+                    f"CPU {result['cpu_percent']:.0f}%, "
+                    f"peak RSS {result['peak_rss_mb']:.0f} MB, "
+                    f"statuses {result['statuses']}"
+                )
+    finally:
+        client.drop_database(BENCH_DB)
+        client.close()
+        fixture.terminate()
+
+    summary = summarize(runs)
+    results = {
+        "timestamp": timestamp,
+        "revision": git_revision(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "docs": BENCH_DOCS,
+            "rounds": ROUNDS,
+            "latency_ms": LATENCY_MS,
+            "latency_jitter_ms": LATENCY_JITTER_MS,
+            "not_found_rate": NOT_FOUND_RATE,
+            "error_rate": ERROR_RATE,
+            "slow_body_rate": SLOW_BODY_RATE,
+            "slow_body_seconds": SLOW_BODY_SECONDS,
+            "crawler_overrides": CRAWLER_OVERRIDES,
+        },
+        "runs": runs,
+        "summary": summary,
+    }
+    if BASELINE_FILE:
+        results["regressions"] = compare_with_baseline(summary, BASELINE_FILE)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_file = os.path.join(RESULTS_DIR, f"crawler_benchmark_{timestamp}.json")
+    with open(results_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    for engine, engine_summary in summary.items():
+        logger.info(f"{engine}: {engine_summary}")
+    logger.info(f"Results saved to {results_file}")
+    logger.info("=== Benchmark completed ===")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,310 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Responses that mean the host wants us to slow down
+THROTTLE_STATUSES = {429, 503}
+
+
+def url_domain(url):
+    return urlsplit(url).hostname or ""
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (the HTTP-date form is ignored)"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class DomainState:
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latency = None  # EWMA, seconds
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+
+
+class AimdLimiter:
+    """Per-domain concurrency limits adjusted by additive increase / multiplicative decrease.
+
+    Every healthy response adds increase / limit (about +increase per round of
+    limit requests) while the latency EWMA stays under latency_target; a 429/503,
+    5xx or timeout multiplies the limit by decrease, at most once per round trip
+    (the latency EWMA) so a burst of failures from one round counts once. Not
+    thread-safe: the gates below serialize access.
+    """
+
+    def __init__(
+        self,
+        initial,
+        minimum,
+        maximum,
+        increase=1.0,
+        decrease=0.5,
+        latency_target=None,
+        adaptive=True,
+    ):
+        self.initial = initial if adaptive else maximum
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.adaptive = adaptive
+        self.domains = {}
+
+    def state(self, domain):
+        if domain not in self.domains:
+            self.domains[domain] = DomainState(self.initial)
+        return self.domains[domain]
+
+    def can_start(self, domain, now):
+        state = self.state(domain)
+        return state.in_flight < int(state.limit) and now >= state.paused_until
+
+    def started(self, domain):
+        state = self.state(domain)
+        state.in_flight += 1
+        state.requests += 1
+
+    def finished(self, domain, outcome, latency, retry_after=None):
+        """Record one request: outcome is "ok", "throttled", "error" or "timeout" """
+        state = self.state(domain)
+        state.in_flight -= 1
+        state.latency = (
+            latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+        )
+        now = time.monotonic()
+
+        if outcome == "ok":
+            slow = self.latency_target and state.latency > self.latency_target
+            if self.adaptive and not slow:
+                state.limit = min(
+                    self.maximum, state.limit + self.increase / state.limit
+                )
+            return
+
+        if outcome == "throttled":
+            state.throttled += 1
+            if retry_after:
+                state.paused_until = max(state.paused_until, now + retry_after)
+        elif outcome == "timeout":
+            state.timeouts += 1
+        else:
+            state.errors += 1
+        if self.adaptive and now - state.last_decrease >= state.latency:
+            state.limit = max(self.minimum, state.limit * self.decrease)
+            state.last_decrease = now
+
+    def snapshot(self):
+        return {
+            domain: {
+                "limit": round(state.limit, 1),
+                "in_flight": state.in_flight,
+                "requests": state.requests,
+                "throttled": state.throttled,
+                "errors": state.errors,
+                "timeouts": state.timeouts,
+                "latency_ms": round((state.latency or 0) * 1000),
+            }
+            for domain, state in sorted(self.domains.items())
+        }
+
+    def describe(self):
+        return ", ".join(
+            f"{domain}: limit {s['limit']} ({s['requests']} req, {s['throttled']} throttled, "
+            f"{s['errors']} errors, {s['timeouts']} timeouts, {s['latency_ms']} ms)"
+            for domain, s in self.snapshot().items()
+        )
+
+
+class RequestSlot:
+    """What the caller learned about the request made while holding a slot"""
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+
+    def outcome(self):
+        if self.status in THROTTLE_STATUSES:
+            return "throttled"
+        if self.status is not None and self.status >= 500:
+            return "error"
+        return "ok"
+
+
+class DomainGate:
+    """Blocking per-domain admission for the thread engine"""
+
+    def __init__(self, limiter, timeout_errors=()):
+        self.limiter = limiter
+        self.timeout_errors = timeout_errors
+        self._condition = threading.Condition()
+
+    def slot(self, domain):
+        return _ThreadSlot(self, domain)
+
+    def describe(self):
+        with self._condition:
+            return self.limiter.describe()
+
+    def snapshot(self):
+        with self._condition:
+            return self.limiter.snapshot()
+
+
+class _ThreadSlot:
+    def __init__(self, gate, domain):
+        self.gate = gate
+        self.domain = domain
+        self.request = RequestSlot()
+
+    def __enter__(self):
+        condition = self.gate._condition
+        with condition:
+            while not self.gate.limiter.can_start(self.domain, time.monotonic()):
+                # Timed wait so a Retry-After pause ends without a notify
+                condition.wait(0.5)
+            self.gate.limiter.started(self.domain)
+        self.start = time.monotonic()
+        return self.request
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = _outcome(self.request, exc, self.gate.timeout_errors)
+        with self.gate._condition:
+            self.gate.limiter.finished(
+                self.domain,
+                outcome,
+                time.monotonic() - self.start,
+                self.request.retry_after,
+            )
+            self.gate._condition.notify_all()
+        return False
+
+
+class AsyncDomainGate:
+    """Per-domain admission for the asyncio engine (use from one event loop)"""
+
+    def __init__(self, limiter, timeout_errors=()):
+        self.limiter = limiter
+        self.timeout_errors = timeout_errors
+        self._condition = asyncio.Condition()
+
+    def slot(self, domain):
+        return _AsyncSlot(self, domain)
+
+    def describe(self):
+        return self.limiter.describe()
+
+    def snapshot(self):
+        return self.limiter.snapshot()
+
+
+class _AsyncSlot:
+    def __init__(self, gate, domain):
+        self.gate = gate
+        self.domain = domain
+        self.request = RequestSlot()
+
+    async def __aenter__(self):
+        condition = self.gate._condition
+        async with condition:
+            while not self.gate.limiter.can_start(self.domain, time.monotonic()):
+                try:
+                    await asyncio.wait_for(condition.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+            self.gate.limiter.started(self.domain)
+        self.start = time.monotonic()
+        return self.request
+
+    async def __aexit__(self, exc_type, exc, tb):
+        outcome = _outcome(self.request, exc, self.gate.timeout_errors)
+        async with self.gate._condition:
+            self.gate.limiter.finished(
+                self.domain,
+                outcome,
+                time.monotonic() - self.start,
+                self.request.retry_after,
+            )
+            self.gate._condition.notify_all()
+        return False
+
+
+def _outcome(request, exc, timeout_errors):
+    if exc is None:
+        return request.outcome()
+    if isinstance(exc, timeout_errors):
+        return "timeout"
+    return "error"
+
+
+class RetryScheduler:
+    """Failed jobs waiting for their next attempt, merged back into a crawl's feed.
+
+    batches() hands out the source (a cursor) with due retries slipped in between,
+    then keeps waiting for retries until no job is in flight and none is queued.
+    Call finished() once per job handed out, after schedule() if it failed, so a
+    retry is always queued before its job stops counting as in flight.
+    """
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self._heap = []
+        self._order = itertools.count()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def schedule(self, job, due):
+        """Queue job for time.time() >= due; False when due is past the horizon"""
+        if due - time.time() > self.horizon:
+            return False
+        with self._condition:
+            heapq.heappush(self._heap, (due, next(self._order), job))
+            self._condition.notify_all()
+        return True
+
+    def finished(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _pop_due(self, size):
+        batch = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now and len(batch) < size:
+            batch.append(heapq.heappop(self._heap)[2])
+        return batch
+
+    def batches(self, source, size):
+        source = iter(source)
+        exhausted = False
+        while True:
+            with self._condition:
+                batch = self._pop_due(size)
+            while not exhausted and len(batch) < size:
+                job = next(source, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    batch.append(job)
+
+            with self._condition:
+                while not batch:
+                    if not self._heap and not self._in_flight:
+                        return
+                    wait = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(wait)
+                    batch = self._pop_due(size)
+                self._in_flight += len(batch)
+            yield batch
@@ -0,0 +1,105 @@
+import importlib.util
+import socket
+import threading
+import time
+import requests
+import urllib3.util.connection
+from requests.adapters import HTTPAdapter
+
+# Distinct hosts each session keeps a keep-alive pool for (glamira runs one domain
+# per country), and connections per host in each pool
+POOL_HOSTS = 32
+POOL_MAXSIZE = 1
+DNS_CACHE_TTL = 300
+
+# urllib3 only decodes brotli when the brotli package is installed
+ACCEPT_ENCODING = "gzip, deflate"
+if importlib.util.find_spec("brotli") or importlib.util.find_spec("brotlicffi"):
+    ACCEPT_ENCODING += ", br"
+
+_local = threading.local()
+_dns_cache = {}
+_dns_lock = threading.Lock()
+_getaddrinfo = socket.getaddrinfo
+_create_connection = urllib3.util.connection.create_connection
+_timing_observer = None
+
+
+def get_session(headers=None, pool_maxsize=POOL_MAXSIZE):
+    """Keep-alive requests.Session owned by the calling thread"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(headers or {})
+        session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        _local.session = session
+    return session
+
+
+def _cached_getaddrinfo(*args, **kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.monotonic()
+    with _dns_lock:
+        cached = _dns_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    start = time.perf_counter()
+    result = _getaddrinfo(*args, **kwargs)
+    if _timing_observer is not None:
+        _timing_observer("dns", time.perf_counter() - start)
+    with _dns_lock:
+        _dns_cache[key] = (now + DNS_CACHE_TTL, result)
+    return result
+
+
+def install_dns_cache():
+    """Cache socket.getaddrinfo results for DNS_CACHE_TTL seconds, process-wide"""
+    socket.getaddrinfo = _cached_getaddrinfo
+
+
+def _timed_create_connection(*args, **kwargs):
+    start = time.perf_counter()
+    sock = _create_connection(*args, **kwargs)
+    if _timing_observer is not None:
+        _timing_observer("connect", time.perf_counter() - start)
+    return sock
+
+
+def set_timing_observer(observe):
+    """Report connection setup as observe(stage, seconds): "dns" for lookups that miss
+    the DNS cache, "connect" for every new urllib3 connection (lookup included)"""
+    global _timing_observer
+    _timing_observer = observe
+    urllib3.util.connection.create_connection = _timed_create_connection
+
+
+def conditional_headers(doc):
+    """If-None-Match / If-Modified-Since from validators saved on a product_names doc"""
+    headers = {}
+    if doc.get("etag"):
+        headers["If-None-Match"] = doc["etag"]
+    if doc.get("last_modified"):
+        headers["If-Modified-Since"] = doc["last_modified"]
+    return headers
+
+
+def response_validators(headers):
+    """ETag / Last-Modified of a response, under the field names stored on docs"""
+    validators = {}
+    if headers.get("ETag"):
+        validators["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+
+def declared_charset(headers):
+    """charset parameter of Content-Type, None when the server does not declare one"""
+    for param in headers.get("Content-Type", "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset":
+            return value.strip("\"' ") or None
+    return None
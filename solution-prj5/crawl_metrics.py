@@ -0,0 +1,144 @@
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Log-linear buckets in the spirit of HdrHistogram: SUB_BUCKETS per power of two
+# above 1 microsecond, so a reported quantile is within ~4.4% of the true value
+SUB_BUCKETS = 16
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    """Latency histogram with bounded relative error, in seconds. Not thread-safe."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        micros = value * 1e6
+        index = int(math.log2(micros) * SUB_BUCKETS) + 1 if micros >= 1 else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Upper edge of the bucket holding the q-quantile, capped at the maximum"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(2 ** (index / SUB_BUCKETS) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            **{f"p{q * 100:g}": self.quantile(q) for q in QUANTILES},
+        }
+
+
+class CrawlMetrics:
+    """Per-stage latency histograms plus request counters by domain and HTTP status"""
+
+    def __init__(self):
+        self.stages = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].record(seconds)
+
+    def observe_all(self, timings):
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    def count_request(self, domain, status):
+        """status is the HTTP status code, or None when no response came back"""
+        key = (domain, str(status) if status else "error")
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": {
+                    stage: histogram.summary()
+                    for stage, histogram in sorted(self.stages.items())
+                },
+                "requests": [
+                    {"domain": domain, "status": status, "count": count}
+                    for (domain, status), count in sorted(self.requests.items())
+                ],
+            }
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP crawl_stage_seconds Crawl pipeline stage latency",
+            "# TYPE crawl_stage_seconds summary",
+        ]
+        for stage, summary in snapshot["stages"].items():
+            for q in QUANTILES:
+                lines.append(
+                    f'crawl_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                    f"{summary[f'p{q * 100:g}']}"
+                )
+            lines.append(f'crawl_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]}')
+            lines.append(
+                f'crawl_stage_seconds_count{{stage="{stage}"}} {summary["count"]}'
+            )
+        lines += [
+            "# HELP crawl_requests_total HTTP requests by domain and status",
+            "# TYPE crawl_requests_total counter",
+        ]
+        for row in snapshot["requests"]:
+            lines.append(
+                f'crawl_requests_total{{domain="{row["domain"]}",status="{row["status"]}"}} '
+                f"{row['count']}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serve metrics.prometheus() on http://host:port/metrics from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
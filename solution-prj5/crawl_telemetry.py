@@ -0,0 +1,106 @@
+import atexit
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+import psutil
+
+
+class SamplingFilter(logging.Filter):
+    """Keep about rate of the records below WARNING from the sampled loggers"""
+
+    def __init__(self, rate, loggers):
+        super().__init__()
+        self.rate = rate
+        self.loggers = tuple(loggers)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        if not record.name.startswith(self.loggers):
+            return True
+        return random.random() < self.rate
+
+
+def queue_logging(logger, sample_rate=1.0, sampled_loggers=()):
+    """Move logger's handlers behind a QueueHandler, so logging calls only enqueue
+    the record and a listener thread does the formatting and I/O.
+
+    The queue is a multiprocessing one, so records from forked worker processes
+    reach the same handlers. Records below WARNING from sampled_loggers are kept
+    at sample_rate before they are queued. The listener is flushed at exit.
+    """
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    records = multiprocessing.Queue(-1)
+    queue_handler = QueueHandler(records)
+    if sampled_loggers:
+        queue_handler.addFilter(SamplingFilter(sample_rate, sampled_loggers))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class SystemMetricsSampler:
+    """Background thread logging CPU, memory and network throughput every interval"""
+
+    def __init__(self, interval, logger):
+        self.interval = interval
+        self.logger = logger
+        self.latest = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_net = None
+        self._last_time = None
+
+    def sample(self):
+        """Take and log one sample; CPU is averaged since the previous sample"""
+        now = time.monotonic()
+        net = psutil.net_io_counters()
+        elapsed = now - self._last_time if self._last_time else None
+        recv_rate = sent_rate = 0.0
+        if elapsed:
+            recv_rate = (net.bytes_recv - self._last_net.bytes_recv) / elapsed
+            sent_rate = (net.bytes_sent - self._last_net.bytes_sent) / elapsed
+        self._last_net, self._last_time = net, now
+
+        memory = psutil.virtual_memory()
+        self.latest = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory.percent,
+            "memory_used_gb": memory.used / 1024**3,
+            "net_recv_mb_s": recv_rate / 1024**2,
+            "net_sent_mb_s": sent_rate / 1024**2,
+        }
+        self.logger.info(
+            f"System Metrics: CPU Usage: {self.latest['cpu_percent']}% | "
+            f"Memory Usage: {memory.percent}% ({self.latest['memory_used_gb']:.2f} GB) | "
+            f"Network: {self.latest['net_recv_mb_s']:.2f} MB/s in, "
+            f"{self.latest['net_sent_mb_s']:.2f} MB/s out"
+        )
+        return self.latest
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        # Prime the CPU and network counters so the first sample covers an interval
+        psutil.cpu_percent(interval=None)
+        self._last_net = psutil.net_io_counters()
+        self._last_time = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread and log a final sample"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.sample()
@@ -0,0 +1,155 @@
+import mmap
+import socket
+import struct
+import numpy as np
+
+# Column position of the country pointer per BIN type (same table as the IP2Location library)
+COUNTRY_POSITION = (0,) + (2,) * 26
+
+MAX_IPV4_RANGE = 4294967295
+INVALID_IP = "INVALID IP ADDRESS"
+IPV6_MISSING = "IPV6 ADDRESS MISSING IN IPV4 BIN"
+
+# 6to4 (2002::/16), Teredo (2001:0000::/32) and IPv4-mapped (::ffff:0:0/96) ranges
+# resolve against the IPv4 table, like IP2Location.get_all does
+_FROM_6TO4 = 42545680458834377588178886921629466624
+_TO_6TO4 = 42550872755692912415807417417958686719
+_FROM_TEREDO = 42540488161975842760550356425300246528
+_TO_TEREDO = 42540488241204005274814694018844196863
+_FROM_V4MAPPED = 281470681743360
+_TO_V4MAPPED = 281474976710655
+
+
+def _read_string(buf, offset):
+    length = buf[offset]
+    return bytes(buf[offset + 1 : offset + 1 + length]).decode("iso-8859-1")
+
+
+class IP2LocationIndex:
+    """IP2Location BIN ranges loaded once into sorted NumPy arrays for batch lookups
+
+    The BIN file is memory-mapped read-only, so processes forked after the index is
+    built share the same page-cache copy of the database and of the range arrays.
+    """
+
+    def __init__(self, db_path):
+        with open(db_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._load(self._mm)
+
+    def _load(self, buf):
+        db_type, db_column = buf[0], buf[1]
+        ipv4_count, ipv4_addr, ipv6_count, ipv6_addr = struct.unpack_from("<4I", buf, 5)
+        if db_type >= len(COUNTRY_POSITION) or COUNTRY_POSITION[db_type] == 0:
+            raise ValueError(f"Unsupported IP2Location BIN type: {db_type}")
+        column = COUNTRY_POSITION[db_type] - 1
+
+        # IPv4 rows: ip_from + (db_column - 1) uint32 pointers
+        v4_rows = np.frombuffer(
+            buf, dtype="<u4", count=ipv4_count * db_column, offset=ipv4_addr - 1
+        ).reshape(ipv4_count, db_column)
+        v4_starts = np.ascontiguousarray(v4_rows[:, 0])
+        v4_pointers = v4_rows[:, column]
+
+        # IPv6 rows: 16-byte little-endian ip_from + (db_column - 1) uint32 pointers.
+        # Starts are stored as big-endian 16-byte strings so they sort like the integers.
+        v6_width = db_column * 4 + 12
+        v6_rows = np.frombuffer(
+            buf,
+            dtype=np.uint8,
+            count=ipv6_count * v6_width,
+            offset=max(ipv6_addr - 1, 0),
+        ).reshape(ipv6_count, v6_width)
+        v6_starts = np.ascontiguousarray(v6_rows[:, 15::-1]).view("S16").ravel()
+        pointer_at = 12 + column * 4
+        v6_pointers = (
+            np.ascontiguousarray(v6_rows[:, pointer_at : pointer_at + 4])
+            .view("<u4")
+            .ravel()
+        )
+
+        # Country strings are shared between rows, so decode each distinct pointer once
+        pointers, inverse = np.unique(
+            np.concatenate([v4_pointers, v6_pointers]), return_inverse=True
+        )
+        self.countries = [
+            (_read_string(buf, int(p)), _read_string(buf, int(p) + 3)) for p in pointers
+        ]
+        self.countries.append((INVALID_IP, INVALID_IP))
+        self.countries.append((IPV6_MISSING, IPV6_MISSING))
+        self._invalid_idx = len(self.countries) - 2
+        self._ipv6_missing_idx = len(self.countries) - 1
+
+        inverse = inverse.astype(np.int16)
+        self.v4_starts = v4_starts
+        self.v4_country = inverse[:ipv4_count]
+        self.v6_starts = v6_starts
+        self.v6_country = inverse[ipv4_count:]
+
+    def _parse(self, ips):
+        """Split addresses into IPv4 numbers and packed IPv6 values"""
+        v4_pos, v4_nums, v6_pos, v6_packed, invalid_pos = [], [], [], [], []
+        for i, ip in enumerate(ips):
+            try:
+                if ":" in ip:
+                    packed = socket.inet_pton(socket.AF_INET6, ip)
+                    ipnum = int.from_bytes(packed, "big")
+                    if _FROM_6TO4 <= ipnum <= _TO_6TO4:
+                        v4_pos.append(i)
+                        v4_nums.append((ipnum >> 80) % 4294967296)
+                    elif _FROM_TEREDO <= ipnum <= _TO_TEREDO:
+                        v4_pos.append(i)
+                        v4_nums.append(~ipnum % 4294967296)
+                    elif _FROM_V4MAPPED <= ipnum <= _TO_V4MAPPED:
+                        v4_pos.append(i)
+                        v4_nums.append(ipnum - _FROM_V4MAPPED)
+                    else:
+                        v6_pos.append(i)
+                        v6_packed.append(packed)
+                else:
+                    v4_nums.append(
+                        struct.unpack("!L", socket.inet_pton(socket.AF_INET, ip))[0]
+                    )
+                    v4_pos.append(i)
+            except (OSError, TypeError, ValueError):
+                invalid_pos.append(i)
+        return v4_pos, v4_nums, v6_pos, v6_packed, invalid_pos
+
+    def lookup(self, ips):
+        """Resolve a batch of IP strings to indexes into self.countries (-1 = not found)"""
+        result = np.full(len(ips), -1, dtype=np.int16)
+        v4_pos, v4_nums, v6_pos, v6_packed, invalid_pos = self._parse(ips)
+
+        if v4_pos:
+            nums = np.minimum(np.array(v4_nums, dtype=np.uint32), MAX_IPV4_RANGE - 1)
+            rows = np.searchsorted(self.v4_starts, nums, side="right") - 1
+            found = rows >= 0
+            v4_pos = np.array(v4_pos)
+            result[v4_pos[found]] = self.v4_country[rows[found]]
+
+        if v6_pos:
+            v6_pos = np.array(v6_pos)
+            if len(self.v6_starts) == 0:
+                result[v6_pos] = self._ipv6_missing_idx
+            else:
+                values = np.array(v6_packed, dtype="S16")
+                rows = np.searchsorted(self.v6_starts, values, side="right") - 1
+                found = rows >= 0
+                result[v6_pos[found]] = self.v6_country[rows[found]]
+
+        if invalid_pos:
+            result[np.array(invalid_pos)] = self._invalid_idx
+        return result
+
+    def lookup_locations(self, ips):
+        """Resolve a batch of IP strings to location dicts (None when no range matches)"""
+        locations = []
+        for idx in self.lookup(ips).tolist():
+            if idx < 0:
+                locations.append(None)
+            else:
+                country_code, country_name = self.countries[idx]
+                locations.append(
+                    {"country_code": country_code, "country_name": country_name}
+                )
+        return locations
@@ -0,0 +1,26 @@
+import ipaddress
+from bson.binary import Binary
+
+# IPv4 addresses are shifted into the signed range so they fit a BSON int32 and keep
+# their sort order; IPv6 addresses are stored as 16 raw bytes
+IPV4_OFFSET = 2**31
+
+
+def encode_ip(ip):
+    """Compact BSON value for an IP string (invalid IPs are kept as strings)"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 4:
+        return int(address) - IPV4_OFFSET
+    return Binary(address.packed)
+
+
+def decode_ip(value):
+    """IP string for a value written by encode_ip"""
+    if isinstance(value, int):
+        return str(ipaddress.IPv4Address(value + IPV4_OFFSET))
+    if isinstance(value, bytes):
+        return str(ipaddress.IPv6Address(bytes(value)))
+    return value
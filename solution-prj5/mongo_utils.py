@@ -0,0 +1,163 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import errors
+
+logger = logging.getLogger(__name__)
+
+
+def split_id_ranges(collection, parts, query=None):
+    """Split the documents matching query into roughly equal half-open _id ranges.
+
+    Returns (lower, upper, count) tuples covering lower <= _id < upper. $bucketAuto
+    reports each bucket's max as the next bucket's min, so only the last bucket
+    includes its max; its upper is None (no upper bound).
+    """
+    pipeline = [
+        {"$match": query or {}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": parts}},
+    ]
+    buckets = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return [
+        (
+            bucket["_id"]["min"],
+            buckets[i + 1]["_id"]["min"] if i + 1 < len(buckets) else None,
+            bucket["count"],
+        )
+        for i, bucket in enumerate(buckets)
+    ]
+
+
+def id_range_query(query, lower, upper):
+    """Restrict query to lower <= _id < upper (no upper bound when upper is None)"""
+    id_range = {"$gte": lower}
+    if upper is not None:
+        id_range["$lt"] = upper
+    return {**(query or {}), "_id": id_range}
+
+
+def get_watermark(db, name):
+    """Return the high-water mark stored for name, or None on the first run"""
+    state = db["pipeline_state"].find_one({"_id": name})
+    return state["watermark"] if state else None
+
+
+def set_watermark(db, name, value):
+    """Record value as the high-water mark for name"""
+    db["pipeline_state"].update_one(
+        {"_id": name},
+        {"$set": {"watermark": value, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+def merge_stage(target, on):
+    """$merge stage that inserts new keys and leaves existing target documents alone"""
+    return {
+        "$merge": {
+            "into": target.name,
+            "on": on,
+            "whenMatched": "keepExisting",
+            "whenNotMatched": "insert",
+        }
+    }
+
+
+def run_merge_pipeline(source, pipeline, target, poll_interval=10):
+    """Run a pipeline ending in $merge server-side, logging target growth until it finishes.
+
+    The growth is only a progress hint: merges running concurrently into the same
+    target all add to it. Use run_partitioned_merges to count what was added.
+    """
+    before = target.estimated_document_count()
+    failure = []
+
+    def run():
+        try:
+            source.aggregate(pipeline, allowDiskUse=True)
+        except Exception as e:
+            failure.append(e)
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    while worker.is_alive():
+        worker.join(poll_interval)
+        if worker.is_alive():
+            logger.info(
+                f"$merge into '{target.name}' running: "
+                f"{target.estimated_document_count() - before} documents added so far..."
+            )
+    if failure:
+        raise failure[0]
+
+    logger.info(f"$merge into '{target.name}' finished")
+
+
+def object_id_partitions(collection, parts, lower=None, upper=None):
+    """Split (lower, upper] of an ObjectId _id space into parts equal time ranges.
+
+    Without lower the range starts at (and includes) the oldest _id in collection.
+    Returns _id conditions that together cover the range exactly once.
+    """
+    if upper is None:
+        newest = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        if newest is None:
+            return []
+        upper = newest["_id"]
+    lower_op = "$gt"
+    if lower is None:
+        oldest = collection.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+        lower, lower_op = oldest["_id"], "$gte"
+
+    start = lower.generation_time.timestamp()
+    step = (upper.generation_time.timestamp() - start) / parts
+    boundaries = [
+        ObjectId.from_datetime(datetime.fromtimestamp(start + step * i, timezone.utc))
+        for i in range(1, parts)
+    ]
+    # ObjectIds sharing the boundary second sort above it, so ranges stay disjoint
+    boundaries = sorted(b for b in set(boundaries) if lower < b <= upper)
+
+    conditions = []
+    previous = (lower_op, lower)
+    for boundary in boundaries:
+        conditions.append({previous[0]: previous[1], "$lt": boundary})
+        previous = ("$gte", boundary)
+    conditions.append({previous[0]: previous[1], "$lte": upper})
+    return conditions
+
+
+def run_partitioned(fn, partitions, concurrency):
+    """Call fn(partition) for every partition from a thread pool, returning the results"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(fn, partitions))
+
+
+def run_partitioned_merges(fn, partitions, concurrency, target):
+    """run_partitioned for partitions that $merge into target: documents target gained.
+
+    The partitions' merges run concurrently, so target is counted once before and
+    once after all of them rather than per partition.
+    """
+    before = target.count_documents({})
+    run_partitioned(fn, partitions, concurrency)
+    return target.count_documents({}) - before
+
+
+def retry_on_duplicate_key(fn, attempts=3):
+    """Retry an idempotent upsert/$merge that lost a race on a unique index"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except (errors.BulkWriteError, errors.OperationFailure) as e:
+            if attempt == attempts or 11000 not in _error_codes(e):
+                raise
+            logger.warning(f"Duplicate key race, retrying ({attempt}/{attempts})")
+
+
+def _error_codes(error):
+    if isinstance(error, errors.BulkWriteError):
+        return {e.get("code") for e in error.details.get("writeErrors", [])}
+    return {error.code}
@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+
+class PageArchive:
+    """On-disk archive of fetched pages.
+
+    Bodies are stored once per content hash as objects/<sha[:2]>/<sha>.gz, and
+    every fetch appends a record (url, product_id, fetched_at, status, headers,
+    sha256) to an NDJSON file owned by the writing process.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.records_dir = os.path.join(root, "records")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.records_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._records_file = None
+        self._records_pid = None
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], f"{sha256}.gz")
+
+    def _write_object(self, sha256, body):
+        path = self._object_path(sha256)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial object
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def _append_record(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._records_pid != os.getpid():
+                name = f"records-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}.ndjson"
+                self._records_file = open(
+                    os.path.join(self.records_dir, name), "a", encoding="utf-8"
+                )
+                self._records_pid = os.getpid()
+            self._records_file.write(line)
+            self._records_file.flush()
+
+    def save(self, url, product_id, status, headers, body):
+        """Archive one response body and return its record"""
+        sha256 = hashlib.sha256(body).hexdigest()
+        self._write_object(sha256, body)
+        record = {
+            "url": url,
+            "product_id": product_id,
+            "fetched_at": datetime.now(timezone.utc).isoformat(),
+            "status": status,
+            "headers": dict(headers),
+            "sha256": sha256,
+            "size": len(body),
+        }
+        self._append_record(record)
+        return record
+
+    def read_body(self, sha256):
+        with gzip.open(self._object_path(sha256), "rb") as f:
+            return f.read()
+
+    def iter_records(self):
+        for name in sorted(os.listdir(self.records_dir)):
+            if not name.endswith(".ndjson"):
+                continue
+            with open(os.path.join(self.records_dir, name), encoding="utf-8") as f:
+                for line in f:
+                    # Skip a line cut short by a crash mid-write
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+    def latest_records(self):
+        """Most recent record for every archived URL"""
+        latest = {}
+        for record in self.iter_records():
+            current = latest.get(record["url"])
+            if current is None or record["fetched_at"] > current["fetched_at"]:
+                latest[record["url"]] = record
+        return list(latest.values())
+
+    def close(self):
+        with self._lock:
+            if self._records_file is not None:
+                self._records_file.close()
+                self._records_file = None
+                self._records_pid = None
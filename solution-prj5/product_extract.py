@@ -0,0 +1,206 @@
+import importlib.util
+import logging
+import time
+from bs4 import BeautifulSoup, UnicodeDammit
+
+logger = logging.getLogger(__name__)
+
+# Tried in order, the first one with text wins
+SELECTORS = [
+    {"name": "h1", "class": "product-name"},
+    {"class": "product-title"},
+    {"class": "product_title"},
+    {"name": "h1"},
+]
+# CSS-style names (h1.product-name) recorded on failed docs as the selectors tried
+SELECTOR_NAMES = [
+    selector.get("name", "") + (f".{selector['class']}" if "class" in selector else "")
+    for selector in SELECTORS
+]
+NO_PARSER = {"lxml": 0, "html5lib": 0, "html.parser": 0}
+
+# Parser for the full BeautifulSoup tree, picked once instead of per page
+PARSER = next(
+    parser
+    for parser, module in [
+        ("lxml", "lxml"),
+        ("html5lib", "html5lib"),
+        ("html.parser", "html"),
+    ]
+    if importlib.util.find_spec(module)
+)
+
+# Fast path: SELECTORS as XPath over a bare lxml tree, which skips building
+# BeautifulSoup objects for the whole page. Text nodes of scripts, styles and
+# comments are left out, like get_text() does
+if importlib.util.find_spec("lxml"):
+    import lxml.html
+    from lxml import etree
+
+    def _class_test(name):
+        return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+    FAST_SELECTORS = [
+        (
+            selector,
+            etree.XPath(
+                f"//{selector.get('name', '*')}"
+                + (f"[{_class_test(selector['class'])}]" if "class" in selector else "")
+            ),
+        )
+        for selector in SELECTORS
+    ]
+    UTF8_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+    _TEXT = etree.XPath(".//text()[not(ancestor::script) and not(ancestor::style)]")
+else:
+    FAST_SELECTORS = None
+
+
+def _add_time(timings, stage, start):
+    """Add the seconds since start to timings[stage] (timings None = not timing)"""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def fast_extract(html, timings=None):
+    """(product_name, selector) from the lxml fast path, (None, None) on a miss.
+
+    With a timings dict, tree building is added to timings["parse"] and selector
+    evaluation to timings["match"]; full_extract does the same.
+    """
+    if FAST_SELECTORS is None:
+        return None, None
+    start = time.perf_counter()
+    if isinstance(html, bytes):
+        # Same encoding detection as BeautifulSoup (lxml alone assumes latin-1)
+        html = UnicodeDammit(html, is_html=True).unicode_markup
+    try:
+        # Parse as UTF-8 bytes: lxml refuses str that carries an XML encoding declaration
+        root = lxml.html.document_fromstring(html.encode("utf-8"), parser=UTF8_PARSER)
+    except (etree.ParserError, ValueError):
+        _add_time(timings, "parse", start)
+        return None, None
+    _add_time(timings, "parse", start)
+    start = time.perf_counter()
+    try:
+        for selector, xpath in FAST_SELECTORS:
+            for element in xpath(root):
+                product_name = "".join(text.strip() for text in _TEXT(element))
+                if product_name:
+                    return product_name, selector
+                # soup.find only looks at the first match of each selector
+                break
+        return None, None
+    finally:
+        _add_time(timings, "match", start)
+
+
+def full_extract(html, parser=PARSER, timings=None):
+    """(product_name, selector) from a full BeautifulSoup tree"""
+    start = time.perf_counter()
+    soup = BeautifulSoup(html, parser)
+    _add_time(timings, "parse", start)
+    start = time.perf_counter()
+    try:
+        for selector in SELECTORS:
+            element = soup.find(**selector)
+            if element:
+                product_name = element.get_text(strip=True)
+                if product_name:
+                    return product_name, selector
+        return None, None
+    finally:
+        _add_time(timings, "match", start)
+
+
+def extract_product_name(html, product_id, source, url, timings=None):
+    """Parse a product page and return (product_name, success, parser_counts)"""
+    parser_counts = dict(NO_PARSER)
+
+    product_name, selector = fast_extract(html, timings)
+    if product_name:
+        parser_counts["lxml"] += 1
+        logger.info(
+            f"Found name for {product_id} using {selector}: {product_name} ({source}, lxml fast path)"
+        )
+        return product_name, True, parser_counts
+
+    # Only a miss pays for the full tree
+    parser_counts[PARSER] += 1
+    product_name, selector = full_extract(html, timings=timings)
+    if product_name:
+        logger.info(
+            f"Found name for {product_id} using {selector}: {product_name} ({source}, {PARSER})"
+        )
+        return product_name, True, parser_counts
+    logger.warning(
+        f"No product name found for {product_id}: {url} ({source}, {PARSER})"
+    )
+    return None, False, parser_counts
+
+
+def extract_page(body, encoding, source, product_id, url, timings=None):
+    """extract_product_name for raw response bytes, picklable for parser processes.
+
+    Without a declared charset the bytes go to the parser as-is, so the page's own
+    <meta charset> is honoured.
+    """
+    start = time.perf_counter()
+    html = body
+    if encoding:
+        try:
+            html = body.decode(encoding, errors="replace")
+        except LookupError:
+            pass
+    _add_time(timings, "parse", start)
+    return extract_product_name(html, product_id, source, url, timings)
+
+
+def timed_extract_page(body, encoding, source, product_id, url):
+    """extract_page plus its {"parse": seconds, "match": seconds} as a fourth item,
+    so parser processes can hand their timings back"""
+    timings = {}
+    return (*extract_page(body, encoding, source, product_id, url, timings), timings)
+
+
+def benchmark(pages, repeat=3):
+    """Time the fast path against the full-tree path on the same pages.
+
+    Returns seconds per page for both and the number of pages where they disagree.
+    """
+    timings = {}
+    for name, extract in [("full", full_extract), ("fast", fast_extract)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            results = [extract(page)[0] for page in pages]
+        timings[name] = (time.perf_counter() - start) / (repeat * max(len(pages), 1))
+        timings[f"{name}_found"] = sum(1 for result in results if result)
+    fast_results = [fast_extract(page)[0] or full_extract(page)[0] for page in pages]
+    full_results = [full_extract(page)[0] for page in pages]
+    timings["mismatches"] = sum(a != b for a, b in zip(fast_results, full_results))
+    timings["speedup"] = timings["full"] / max(timings["fast"], 1e-12)
+    return timings
+
+
+if __name__ == "__main__":
+    # Benchmark on the crawler's page archive: python product_extract.py
+    from page_archive import PageArchive
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    archive = PageArchive("page_archive")
+    pages = [
+        archive.read_body(record["sha256"])
+        for record in archive.latest_records()
+        if record["status"] < 400
+    ]
+    logger.info(
+        f"Benchmarking {len(pages)} archived pages with {PARSER} as full-tree parser"
+    )
+    result = benchmark(pages)
+    logger.info(
+        f"Full tree: {result['full'] * 1000:.2f} ms/page ({result['full_found']} found), "
+        f"fast path: {result['fast'] * 1000:.2f} ms/page ({result['fast_found']} found), "
+        f"{result['speedup']:.1f}x faster, {result['mismatches']} mismatches"
+    )
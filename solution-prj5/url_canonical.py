@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from pymongo import UpdateOne
+
+# Query parameters that only pick a variant (metal, stones, size) of the product
+# shown on the same page, or that only track where the visitor came from
+VARIANT_PARAMS = {"alloy", "diamond", "size", "carat", "dimension", "engraving"}
+VARIANT_PREFIXES = ("stone", "pearl")
+TRACKING_PARAMS = {"gclid", "fbclid", "msclkid", "dclid", "ref", "_ga"}
+TRACKING_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+MAX_REDIRECT_HOPS = 10
+
+
+def _kept_param(name):
+    name = name.lower()
+    if name in VARIANT_PARAMS or name in TRACKING_PARAMS:
+        return False
+    return not name.startswith(VARIANT_PREFIXES + TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """Lowercase scheme and host, drop default ports, fragments, variant and tracking
+    parameters; the remaining query parameters are sorted"""
+    split = urlsplit(url.strip())
+    scheme = split.scheme.lower()
+    netloc = split.hostname or ""
+    try:
+        if split.port and split.port != DEFAULT_PORTS.get(scheme):
+            netloc += f":{split.port}"
+    except ValueError:
+        # Unparseable port, keep it as written
+        netloc = split.netloc.lower()
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(split.query, keep_blank_values=True)
+        if _kept_param(name)
+    )
+    return urlunsplit((scheme, netloc, split.path or "/", urlencode(query), ""))
+
+
+def canonical_url(url, redirects=None):
+    """normalize_url, then follow known redirects (a dict of canonical source -> target)"""
+    canonical = normalize_url(url)
+    seen = {canonical}
+    for _ in range(MAX_REDIRECT_HOPS):
+        target = (redirects or {}).get(canonical)
+        if target is None or target in seen:
+            break
+        canonical = target
+        seen.add(canonical)
+    return canonical
+
+
+def load_redirects(collection):
+    """Known redirects from the url_redirects collection"""
+    return {doc["_id"]: doc["target"] for doc in collection.find({}, {"target": 1})}
+
+
+def redirect_upsert(source, target):
+    """Record that canonical URL source redirects to canonical URL target"""
+    return UpdateOne(
+        {"_id": source},
+        {"$set": {"target": target, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
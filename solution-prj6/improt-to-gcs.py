@@ -1,4 +1,5 @@
 import os
+import ipaddress
 import logging
 from pymongo import MongoClient
 import pandas as pd
@@ -21,6 +22,10 @@ COLLECTIONS = ["distinct_ips", "product_names", "summary"]
 EXPORT_PATH = "./data"
 BATCH_SIZE = 100
 GCS_BUCKET_NAME = "dec-project-bucket"  # <-- Replace with actual GCS bucket name
+# Compact IP collections (solution-prj5/2.1.compact-distinct-ips.py) are decoded back
+# to the distinct_ips schema on export. Add them to COLLECTIONS to export them.
+COMPACT_IP_COLLECTIONS = ["distinct_ips_compact"]
+IPV4_OFFSET = 2**31  # Same encoding as solution-prj5/ip_codec.py
 
 # --- Mongo Connection ---
 def connect_mongo():
@@ -33,6 +38,28 @@ def connect_mongo():
         logging.error(f"❌ MongoDB connection failed: {e}")
         raise
 
+# --- Compact IP decoding ---
+def decode_ip(value):
+    if isinstance(value, int):
+        return str(ipaddress.IPv4Address(value + IPV4_OFFSET))
+    if isinstance(value, bytes):
+        return str(ipaddress.IPv6Address(bytes(value)))
+    return value
+
+def decode_compact_ips(batch, countries):
+    decoded = []
+    for doc in batch:
+        code = doc.get("cc")
+        location = None
+        if code is not None:
+            location = {"country_code": code, "country_name": countries.get(code, code)}
+        decoded.append({
+            "ip": decode_ip(doc["_id"]),
+            "location": location,
+            "status": doc.get("status", "done"),
+        })
+    return decoded
+
 # --- Upload to GCS ---
 def upload_to_gcs(local_path, blob_name):
     try:
@@ -58,12 +85,19 @@ def export_collection_to_parquet(db, collection_name, test_mode=False, sample_si
         logging.info(f"{collection_name}: {total_docs} documents found.")
         cursor = collection.find()
 
+    countries = None
+    if collection_name in COMPACT_IP_COLLECTIONS:
+        countries = {c["_id"]: c["name"] for c in db["countries"].find()}
+
     batch_num = 0
     while True:
         batch = list(cursor.limit(BATCH_SIZE).skip(batch_num * BATCH_SIZE))
         if not batch:
             break
 
+        if countries is not None:
+            batch = decode_compact_ips(batch, countries)
+
         df = pd.DataFrame(batch)
 
         if "_id" in df.columns: